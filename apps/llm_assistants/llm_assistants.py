@@ -1,6 +1,6 @@
 import appdaemon.plugins.hass.hassapi as hass
 import pytz
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 import json
 import requests
 from langchain_openai import ChatOpenAI
@@ -11,11 +11,22 @@ from langchain_community.utilities.sql_database import SQLDatabase
 # from serpapi import GoogleSearch
 import traceback
 import os
-from llm_classes import Assistant, FastAPIClient
-from llm_tools import get_tools
-from datetime import datetime
+import re
+import threading
+from llm_classes import (
+    Assistant, FastAPIClient, ApiCallCounter, KnowledgeWatcher, VectorStoreRouter, HashingEmbedder, OpenAIEmbedder,
+    TTLCache, AsyncAssistant, AssistantRequestQueue, InstructionBuilder, LocalCommandMatcher, ExampleIndex,
+    ThreadRunCoordinator
+)
+from llm_helpers import normalize_prompt, serial_tool, get_token_counter, compact_value
+from llm_tools import get_tools, READ_ONLY_TOOLS
+from datetime import datetime, timedelta
+from functools import partial
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import yaml
 import pytz
+import time
 from smarthome_global import *
 
 
@@ -27,14 +38,18 @@ class LLMAssistants(Base):
         self.log_info("Starting LLM Assistants Services")
         super().initialize()  # Initialize the Base class
 
-        # self.fast_api_client = FastAPIClient("http://localhost:8000")
+        self.load_fast_api_client()
         self.define_apps()
         self.define_tools()
         self.load_open_ai()
         # self.delete_all_files_and_stores() # Hail Mary to delete all files and stores
 
         self.load_agents()
+        self.load_example_index()
         self.load_assistants()
+        self.load_vector_store_router()
+        self.load_fast_path()
+        self.load_response_cache()
         self.listen_for_user_input()
 
         self.manager.register_app(
@@ -99,23 +114,42 @@ class LLMAssistants(Base):
             'get_automation_status': self.get_automation_status,
 
         }
+        # Entities get_automation_status reads, per app
+        self.automation_booleans = {
+            app: tuple(self.apps[app].room_automation_booleans)
+            for app in self.apps if getattr(self.apps[app], 'room_automation_booleans', None)
+        }
 
-    def get_automation_status(self, app=None):
-        status = {}
-        if app:
-            for entity in self.apps[app].room_automation_booleans:
-                state = self.get_state(entity, attribute='all')
-                self.log_info(f"{entity}: {state}")
-                status[entity] = state
-        else:
-            for app in self.apps:
-                for entity in self.apps[app].room_automation_booleans:
-                    state = self.get_state(entity, attribute='all')
-                    self.log_info(f"{entity}: {state}")
-                    status[entity] = state
+    def get_automation_status(self, app=None, summary=False):
+        # One snapshot of every state filtered to the automation booleans, instead of a lookup per entity
+        if app and app not in self.automation_booleans:
+            return f"Unknown app {app}, expected one of {list(self.automation_booleans)}"
+        automation_booleans = {app: self.automation_booleans[app]} if app else self.automation_booleans
 
+        states = self.get_state()
+        status = {
+            entity: states.get(entity)
+            for entities in automation_booleans.values() for entity in entities
+        }
+        self.log_info(f"Automation status of {len(status)} entities for {list(automation_booleans)}")
+        if summary:
+            return self.summarize_automation_status(automation_booleans, status)
         return status
 
+    @staticmethod
+    def summarize_automation_status(automation_booleans, status):
+        summary = {}
+        for app, entities in automation_booleans.items():
+            states = {entity: (status.get(entity) or {}).get('state', 'unknown') for entity in entities}
+            counts = Counter(states.values())
+            usual = counts.most_common(1)[0][0] if counts else None
+            summary[app] = {
+                'counts': dict(counts),
+                'exceptions': {entity: state for entity, state in states.items() if state != usual},
+            }
+        return summary
+
+    @serial_tool
     def modify_home_database(self, sql):
         """Execute a SQL command on the Home Database"""
         try:
@@ -180,7 +214,12 @@ class LLMAssistants(Base):
 
     def load_open_ai(self):
         os.environ["OPENAI_API_KEY"] = self.args['openai_api_key']
-        self.client = OpenAI()
+        # Count every OpenAI request so startup and sync costs can be measured
+        self.api_calls = ApiCallCounter()
+        self.client = OpenAI(http_client=DefaultHttpxClient(event_hooks={'request': [self.api_calls]}))
+        self.async_client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(event_hooks={'request': [self.api_calls.async_hook]})
+        )
         self.model = ChatOpenAI(model='gpt-4o-mini')
         self.parser = StrOutputParser()
         self.message_chain = self.model | self.parser
@@ -209,31 +248,170 @@ class LLMAssistants(Base):
         self.agents = {}
         self.agents.update(self.load_sql_agents())
 
+    def load_example_index(self):
+        # Few shot examples are picked in process, no generate_prompt service round trip
+        # Inputs are short, the wider hashing space keeps unrelated words from colliding
+        embedder = OpenAIEmbedder(self.client) if self.args.get('example_embedder') == 'openai' \
+            else HashingEmbedder(dimensions=4096)
+        self.example_index = ExampleIndex(
+            folders=[f'/conf/assistants/{assistant}/examples' for assistant in os.listdir('/conf/assistants')],
+            embedder=embedder,
+            cache_path=self.args.get('example_index_path', '/conf/.llm_assistants_example_index.npz'),
+            logger=self.log,
+        )
+        try:
+            self.example_index.load()
+        except Exception as e:
+            self.log_info(f"Error: {e}")
+            self.log_info(f"Traceback: {''.join(traceback.format_exception(e))}")
+
     def load_assistants(self):
         self.assistants = {}
+        # Conversations run on an event loop instead of holding an AppDaemon thread for the whole run
+        self.request_queue = None
+        if self.args.get('async_engine', False):
+            if self.args.get('stream_responses', False):
+                self.log_info("WARNING: stream_responses is not supported with async_engine, responses will not stream")
+            self.request_queue = AssistantRequestQueue(
+                max_concurrency=self.args.get('max_concurrent_conversations', 4),
+                logger=self.log,
+            )
+
         # Walk through folders in assistants directory and load assistants.
+        # They come up side by side, each one syncing its vector stores in the background
         assistants = os.listdir('/conf/assistants')
-        for assistant in assistants:
-            self.assistants[assistant] = Assistant(
-                client=self.client,
-                assistant_name=assistant,
-                tools=get_tools('all'),
-                tool_funcs=self.tool_funcs,
-                logger=self.log,
-                model=self.model,
-                dynamic_instructions=self.dynamic_instructions()
+        dynamic_instructions = self.dynamic_instructions()
+        with ThreadPoolExecutor(max_workers=max(1, self.args.get('startup_concurrency', 4)),
+                                thread_name_prefix='assistant-startup') as executor:
+            futures = {
+                executor.submit(self.load_assistant, assistant, dynamic_instructions): assistant
+                for assistant in assistants
+            }
+            for future in as_completed(futures):
+                assistant = futures[future]
+                try:
+                    self.assistants[assistant] = future.result()
+                except Exception as e:
+                    self.log_info(f"Error: {e}")
+                    self.log_info(f"Traceback: {''.join(traceback.format_exception(e))}")
+
+        # Every 15 minutes update the vector stores for each assistant
+        # This will allow the AI to provide more accurate responses
+        # Start 15 minutes after initialization
+        # self.run_every(
+        #     callback=self.assistants[assistant].load_vector_stores,
+        #     start=datetime.now(pytz.timezone('America/Chicago')) + timedelta(seconds=60 * 15),
+        #     interval=60 * 15,   # 15 minutes (60 seconds * 15)
+        # )
+
+        for name, assistant in self.assistants.items():
+            self.log_info(f"Startup report for {name}: {assistant.startup_stats}")
+
+        # Devices and patterns change at runtime, re-check the dynamic instructions periodically
+        interval = self.args.get('instructions_refresh_interval', 60 * 10)
+        if interval:
+            self.run_every(
+                callback=self.refresh_dynamic_instructions,
+                start=datetime.now(self.timezone) + timedelta(seconds=interval),
+                interval=interval,
             )
 
-            # Every 15 minutes update the vector stores for each assistant
-            # This will allow the AI to provide more accurate responses
-            # Start 15 minutes after initialization
-            # self.run_every(
-            #     callback=self.assistants[assistant].load_vector_stores,
-            #     start=datetime.now(pytz.timezone('America/Chicago')) + timedelta(seconds=60 * 15),
-            #     interval=60 * 15,   # 15 minutes (60 seconds * 15)
-            # )
+        # Push edits to the knowledge folders as they happen instead of periodic full re-uploads
+        self.knowledge_watcher = None
+        if self.args.get('watch_knowledge_folders', True):
+            self.watch_knowledge_folders()
+
+    def load_assistant(self, assistant, dynamic_instructions):
+        engine = partial(AsyncAssistant, self.async_client, self.request_queue) if self.request_queue else Assistant
+        return engine(
+            client=self.client,
+            assistant_name=assistant,
+            tools=get_tools('all'),
+            tool_funcs=self.tool_funcs,
+            logger=self.log,
+            model=self.model,
+            dynamic_instructions=dynamic_instructions,
+            api_calls=self.api_calls,
+            warm_start=self.args.get('warm_start', True),
+            sync_concurrency=self.args.get('sync_concurrency', 4),
+            upload_concurrency=self.args.get('upload_concurrency', 8),
+            tool_concurrency=self.args.get('tool_concurrency', 8),
+            serial_tools=self.args.get('serial_tools', []),
+            stream_responses=self.args.get('stream_responses', False) and not self.request_queue,
+            max_threads=self.args.get('max_threads', 32),
+            thread_idle_ttl=self.args.get('thread_idle_ttl', 60 * 30),
+            lazy_sync=self.args.get('lazy_vector_store_sync', True),
+            assistant_model=self.args.get('assistant_model'),
+            tool_subsets=self.args.get('tool_subsets', False),
+            tool_cache_ttls=self.args.get('tool_cache_ttls'),
+            tool_output_limits=self.args.get('tool_output_limits'),
+            merge_wait_timeout=self.args.get('merge_wait_timeout', 300),
+        )
+
+    def watch_knowledge_folders(self):
+        folders = ['/conf/vaults'] + [
+            f'{assistant.assistant_folder}/vector_stores' for assistant in self.assistants.values()
+        ]
+        self.knowledge_watcher = KnowledgeWatcher(
+            folders=folders,
+            callback=self.sync_knowledge_paths,
+            logger=self.log,
+            debounce=self.args.get('watch_debounce', 5),
+            poll_interval=self.args.get('watch_poll_interval', 30),
+        )
+        self.knowledge_watcher.start()
+
+    def sync_knowledge_paths(self, paths):
+        self.log_info(f"Knowledge files changed: {paths}")
+        for name, assistant in self.assistants.items():
+            assistant.sync_paths(paths)
+
+    def load_fast_api_client(self):
+        """Pooled client for the local FastAPI service, only created when fast_api.url is set."""
+        self.fast_api_client = None
+        settings = self.args.get('fast_api', {}) or {}
+        if not settings.get('url'):
+            return
+        self.fast_api_client = FastAPIClient(
+            settings['url'],
+            timeout=settings.get('timeout', 10.0),
+            connect_timeout=settings.get('connect_timeout', 3.0),
+            max_connections=settings.get('max_connections', 10),
+            max_keepalive_connections=settings.get('max_keepalive_connections', 5),
+            keepalive_expiry=settings.get('keepalive_expiry', 30.0),
+            retries=settings.get('retries', 2),
+            backoff=settings.get('backoff', 0.25),
+            logger=self.log,
+        )
+        interval = settings.get('stats_interval', 300)
+        self.run_every(
+            callback=self.publish_fast_api_stats,
+            start=datetime.now(self.timezone) + timedelta(seconds=interval),
+            interval=interval,
+        )
+
+    def publish_fast_api_stats(self, kwargs=None):
+        report = self.fast_api_client.latency_report()
+        total_requests = sum(endpoint['count'] for endpoint in report.values())
+        self.set_state('sensor.llm_assistants_fast_api', state=total_requests, attributes={'endpoints': report})
+
+    def terminate(self):
+        if getattr(self, 'fast_api_client', None):
+            self.fast_api_client.close()
+        if getattr(self, 'knowledge_watcher', None):
+            self.knowledge_watcher.stop()
+        if getattr(self, 'request_queue', None):
+            self.request_queue.stop()
 
     def dynamic_instructions(self):
+        # Only the sections whose source data changed are rendered again
+        if not hasattr(self, 'instruction_builder'):
+            self.instruction_builder = InstructionBuilder(
+                logger=self.log,
+                token_counter=get_token_counter(self.args.get('instructions_token_counter', 'estimate')),
+                token_budget=self.args.get('instructions_token_budget'),
+            )
+
         regex_patterns = {
             app: self.apps[app].get_all_patterns()
             for app in self.apps if hasattr(self.apps[app], 'get_all_patterns')
@@ -243,8 +421,50 @@ class LLMAssistants(Base):
             app: self.apps[app].room_entities_data
             for app in self.apps if hasattr(self.apps[app], 'room_entities_data')
         }
+        self.controllable = controllable  # The local fast path matches commands against the same entities
         # Convert dictionary into a string for a dynamic instruction to feed into the AI Assistant
-        regex_patterns_str = """The following Apps and their patterns are available for you to use when using
+        # The compact encoding carries the same data as dense tables, the verbose one is kept to compare sizes
+        verbose = {
+            'patterns_header': self.render_patterns_header,
+            'patterns': self.render_patterns,
+            'controllable_header': self.render_controllable_header,
+            'controllable': self.render_controllable,
+            'available_tools': self.render_available_tools,
+        }
+        compact = {
+            'patterns_header': self.render_compact_patterns_header,
+            'patterns': self.render_compact_patterns,
+            'controllable_header': self.render_compact_controllable_header,
+            'controllable': self.render_compact_controllable,
+            'available_tools': self.render_compact_available_tools,
+        }
+        renderers = compact if self.args.get('instructions_encoding', 'verbose') == 'compact' else verbose
+
+        def section(kind, key, data, app=None):
+            render, baseline = renderers[kind], verbose[kind]
+            if app is not None:
+                render, baseline = partial(render, app), partial(baseline, app)
+            return (key, data, render) if renderers is verbose else (key, data, render, baseline)
+
+        sections = [section('patterns_header', 'patterns_header', None)]
+        sections += [
+            section('patterns', f'patterns:{app}', patterns, app)
+            for app, patterns in regex_patterns.items()
+        ]
+        sections.append(section('controllable_header', 'controllable_header', None))
+        sections += [
+            section('controllable', f'controllable:{app}', rooms, app)
+            for app, rooms in controllable.items()
+        ]
+        # Add Available Tools in Instructions
+        sections.append(section('available_tools', 'available_tools', list(self.tool_funcs.keys())))
+
+        self.instruction_builder.build(sections)
+        return self.instruction_builder.text
+
+    @staticmethod
+    def render_patterns_header(data=None):
+        return """The following Apps and their patterns are available for you to use when using
         command_matching_entities or get_matching_entities or any argument that requires a ReGeX pattern
         
         IT IS VERY IMPORTANT that you do not deviate from the patterns provided here.
@@ -252,69 +472,127 @@ class LLMAssistants(Base):
         
         : \n\n"""
 
-        for app, patterns in regex_patterns.items():
-            regex_patterns_str += f"""
+    @staticmethod
+    def render_patterns(app, patterns):
+        lines = [f"""
             ## {app.title()} Regex Patterns:
-            """
-            for device_type, pattern in patterns.items():
-                regex_patterns_str += f"""
+            """]
+        for device_type, pattern in patterns.items():
+            lines.append(f"""
                 {device_type.title()}:
-                """
-                for entity_type, pat in pattern.items():
-                    regex_patterns_str += f"""
+                """)
+            for entity_type, pat in pattern.items():
+                lines.append(f"""
                     - {entity_type}: 
                         - INCLUDE: {pat[0]}
                         - EXCLUDE: {pat[1]}
-                    """
+                    """)
+        return ''.join(lines)
 
-        regex_patterns_str += f"""
+    @staticmethod
+    def render_controllable_header(data=None):
+        return f"""
         ## Controllable Entities:
         """
-        for app, rooms in controllable.items():
-            regex_patterns_str += f"""
+
+    @staticmethod
+    def render_controllable(app, rooms):
+        lines = [f"""
             ## {app.title()} Controllable Entities:
-            """
-            for room, entities in rooms.items():
-                regex_patterns_str += f"""
+            """]
+        for room, entities in rooms.items():
+            lines.append(f"""
                 {room.title()}:
-                """
-                for entity_type, entity in entities.items():
-                    if entity:
-                        regex_patterns_str += f"""
+                """)
+            for entity_type, entity in entities.items():
+                if entity:
+                    lines.append(f"""
                         - {entity_type.title()}:
                             - {entity}
-                        """
+                        """)
+        return ''.join(lines)
 
-        # Add Available Tools in Instructions
-        available_tools = f"""\n\n
+    @staticmethod
+    def render_available_tools(tool_names):
+        return f"""\n\n
         ## IMPORTANT NOTE:
         
         “You shall only invoke the following defined functions: 
-        {list(self.tool_funcs.keys())}. 
+        {tool_names}. 
         **You should NEVER invent or use functions NOT defined or NOT listed HERE, 
         especially the multi_tool_use.parallel function. 
         If you need to call multiple functions, you will call them one at a time **.
         ”
         """
-        self.log_info(f"""
-        Dynamic Instructions:
-        {regex_patterns_str}
-        """)
-        return regex_patterns_str + available_tools
+
+    @staticmethod
+    def render_compact_patterns_header(data=None):
+        return (
+            "\n# Regex Patterns\n"
+            "Use these patterns exactly, never deviate from them, for command_matching_entities, "
+            "get_matching_entities and any argument that requires a ReGeX pattern.\n"
+            "Rows are device/entity: +`INCLUDE pattern` -`EXCLUDE pattern`.\n"
+        )
+
+    @staticmethod
+    def render_compact_patterns(app, patterns):
+        lines = [f"## {app}"]
+        for device_type, pattern in patterns.items():
+            for entity_type, pat in pattern.items():
+                lines.append(f"{device_type}/{entity_type}: +`{pat[0]}` -`{pat[1]}`")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def render_compact_controllable_header(data=None):
+        return "\n# Controllable Entities\nRows are room: type=entity,entity; type=entity\n"
+
+    @staticmethod
+    def render_compact_controllable(app, rooms):
+        lines = [f"## {app}"]
+        for room, entities in rooms.items():
+            row = '; '.join(
+                f"{entity_type}={compact_value(entity)}" for entity_type, entity in entities.items() if entity
+            )
+            if row:
+                lines.append(f"{room}: {row}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def render_compact_available_tools(tool_names):
+        return (
+            f"\n# IMPORTANT\nOnly call these functions, one at a time: {', '.join(tool_names)}. "
+            f"NEVER invent other functions or use multi_tool_use.parallel.\n"
+        )
+
+    def refresh_dynamic_instructions(self, kwargs=None):
+        """Rebuild the dynamic instructions and push them only when the result changed."""
+        previous = self.instruction_builder.fingerprint
+        dynamic_instructions = self.dynamic_instructions()
+        if self.instruction_builder.fingerprint == previous:
+            return
+        self.load_fast_path()
+        for name, assistant in self.assistants.items():
+            try:
+                assistant.set_dynamic_instructions(dynamic_instructions)
+            except Exception as e:
+                self.log_info(f"Error: {e}")
+                self.log_info(f"Traceback: {''.join(traceback.format_exception(e))}")
 
     def send_event_to_assistant(self, event, data, **kwargs):
         prompt = data.get('prompt')
         thread = data.get('thread_id', 'main')
-        example = self.fast_api_client.send_request_sync(
-            endpoint="generate_prompt",
-            data={"query": content}
-        )
+        command = prompt
+        example = self.example_index.examples_text(prompt, 'command_matching_entities',
+                                                   k=self.args.get('few_shot_examples', 2))
         if example:
             command += f"""
          EXAMPLES:
         {example}
         """
-        response = self.assistants['home-assistant'].message(thread, command)
+        response = self.assistants['home-assistant'].message(thread, command, user_prompt=prompt)
+        if response is ThreadRunCoordinator.MERGED:
+            self.log_info(f"'{prompt}' was answered together with the earlier messages on {thread}")
+            return
         self.fire_event("appdaemon_tool_response", response=response)
 
     def send_command(self, *args, **kwargs):
@@ -329,9 +607,10 @@ class LLMAssistants(Base):
         context = llm_context.get('context')
         user_id = context.get('user_id')
         user = self.user_details.get(user_id, 'gerardo')
-        thread = llm_context.get('thread_id', 'main')
         content = llm_context.get('user_prompt')
         device_id = llm_context.get('device_id')
+        # Every household member and device keeps its own, small conversation
+        thread = llm_context.get('thread_id') or f"{user}:{device_id or platform}"
         metadata = llm_context.get('metadata', {})
         self.log_info(
             f"""
@@ -339,12 +618,20 @@ class LLMAssistants(Base):
             """
         )
         try:
-            # # Enhance the user query with the best example set
-            # example = self.fast_api_client.send_request_sync(
-            #     endpoint="generate_prompt",
-            #     data={"query": content}
-            # )
-            # self.log_info(f"Example content: {example}")
+            # Plain on/off commands for one room are run locally, without a model run
+            reply = self.run_fast_path(content) or self.cached_response(content, user, thread)
+            if reply:
+                self.fire_event("appdaemon_tool_response", response=reply, partial=False)
+                return
+
+            # Enhance the user query with the best example set
+            example = None
+            if self.args.get('few_shot_examples', 2):
+                example = self.example_index.examples_text(
+                    content, 'command_matching_entities',
+                    k=self.args.get('few_shot_examples', 2),
+                    min_score=self.args.get('example_min_score', 0.15),
+                )
 
             # Enhance the user query by attaching a relevant vector store
             # This will allow the AI to provide more accurate responses
@@ -365,26 +652,43 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
  {assistant_input}
 
 """
-            #             if example:
-            #                 command += f"""
-            #  EXAMPLES:
-            # {example}
-            # """
+            if example:
+                command += f"""
+ EXAMPLES:
+{example}
+"""
             if vector_store:
                 command += f"""
    USE VECTOR STORE: {vector_store}    
 """
 
-            response = self.assistants['home-assistant'].message(thread, command, vector_store)
+            if self.request_queue:
+                # Hand the run to the event loop and free this AppDaemon thread right away
+                future = self.request_queue.submit(
+                    self.assistants['home-assistant'].amessage, thread, command, vector_store, content
+                )
+                future.add_done_callback(
+                    lambda done: self.send_queued_response(done, platform, content, user, command, thread)
+                )
+                self.publish_request_queue_stats()
+                return
+
+            response = self.assistants['home-assistant'].message(
+                thread, command, vector_store, user_prompt=content, on_partial=self.send_partial_response
+            )
+            if response is ThreadRunCoordinator.MERGED:
+                self.log_info(f"'{content}' was answered together with the earlier messages on {thread}")
+                return
+            self.cache_response(content, user, command, response, thread)
 
             if request_origin == 'appdaemon_tool_request':
                 self.log_info(f"Sending response back to {platform} with the following response: {response}")
-                self.fire_event("appdaemon_tool_response", response=response)
-
+                self.fire_event("appdaemon_tool_response", response=response, partial=False)
             elif request_origin == 'user_input':
                 self.set_state(entity_id, state='responded', command=content, response=response)
             else:
                 self.log_info(f"Unknown request origin: {request_origin}\n{response}")
+            self.publish_tool_stats()
             # self.manager.notify_tts(response, room_override='office', tts_override=True)
         except Exception as e:
             self.log_info(f"Error: {e}")
@@ -392,12 +696,279 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
 
             error_log = f"Error: {e}\n\nTraceback: {traceback.format_exc()}"
 
+    def load_vector_store_router(self):
+        embedder = OpenAIEmbedder(self.client) if self.args.get('router_embedder') == 'openai' \
+            else HashingEmbedder(dimensions=4096)
+        self.vector_store_router = VectorStoreRouter(
+            embedder=embedder,
+            min_score=self.args.get('router_min_score', 0.06),
+            min_margin=self.args.get('router_min_margin', 0.02),
+            fallback=self.llm_vector_store if self.args.get('router_llm_fallback', True) else None,
+            logger=self.log,
+        )
+        # Repeated commands reuse the previous routing decision
+        self.routing_cache = TTLCache(
+            maxsize=self.args.get('routing_cache_size', 512),
+            ttl=self.args.get('routing_cache_ttl', 60 * 60 * 24),
+        )
+        self.routing_cache_stores = None
+        self.routing_miss_seconds = 0
+
+        # The router is rebuilt in the sync thread after every sync, requests only read the current snapshot
+        self.assistants['home-assistant'].sync_listeners.append(self.refresh_vector_store_router)
+        self.refresh_vector_store_router()
+
+    def refresh_vector_store_router(self):
+        # Runs after every sync and at startup, unchanged files keep their embeddings
+        assistant = self.assistants['home-assistant']
+        generation = assistant.sync_generation
+        # The background sync keeps adding stores and manifest entries, work on a copy
+        stores = assistant.stores_snapshot()
+        signature = (generation, tuple(stores))
+        if self.vector_store_router.signature == signature:
+            return
+
+        descriptions = self.args.get('vector_store_descriptions', {
+            'user_preferences': 'Contain all the user preferences for the home assistant for each user.',
+            'home_automation': 'Contains all the home automation rules, patterns, and usage rules',
+            'Clarity': 'Contains all the PKM files and knowledge for the user Gerardo.',
+        })
+        rebuilt = self.vector_store_router.build(
+            stores={
+                store: {
+                    'description': f"{store.replace('_', ' ')}: {descriptions.get(store, '')}",
+                    'files': {path: entry['hash'] for path, entry in entries.items()},
+                }
+                for store, entries in stores.items()
+            },
+            signature=signature,
+        )
+        if rebuilt:
+            # Decisions taken on the old store contents may no longer hold
+            self.routing_cache.invalidate()
+
+    def load_fast_path(self):
+        self.fast_path = None
+        # Rebuilt whenever the instructions change, the counters carry over
+        self.fast_path_stats = getattr(self, 'fast_path_stats', None) or Counter()
+        if not self.args.get('local_fast_path', True):
+            return
+        master_apps = [
+            app for app in self.apps
+            if hasattr(self.apps[app], 'master_on') and hasattr(self.apps[app], 'master_off')
+        ]
+        self.fast_path = LocalCommandMatcher(self.controllable, master_apps=master_apps)
+
+    def run_fast_path(self, content):
+        """Handle simple on/off commands locally, returns the reply or None to go through the assistant."""
+        if not self.fast_path:
+            return None
+        start = time.perf_counter()
+        self.fast_path_stats['requests'] += 1
+        match = self.fast_path.match(content)
+        if match is None:
+            self.fast_path_stats['missed'] += 1
+            self.publish_fast_path_stats()
+            return None
+
+        name, args, reply = match
+        try:
+            response = self.assistants['home-assistant'].call_tool(name, self.tool_funcs[name], args)
+        except Exception as e:
+            response = f"Error: {e}"
+        # command_matching_entities answers with an empty result when nothing matched or ran
+        if not response or f'{response}'.startswith('Error'):
+            self.log_info(f"Fast path {name}({args}) returned {response!r}, falling back to the assistant")
+            self.fast_path_stats['failed'] += 1
+            self.publish_fast_path_stats()
+            return None
+
+        self.fast_path_stats['handled'] += 1
+        self.log_info(f"Fast path handled '{content}' with {name}({args}) in {(time.perf_counter() - start) * 1000:.0f}ms")
+        self.publish_fast_path_stats()
+        return reply
+
+    def publish_fast_path_stats(self):
+        stats = dict(self.fast_path_stats)
+        stats['handled_rate'] = round(stats.get('handled', 0) / stats['requests'], 3) if stats.get('requests') else 0
+        self.set_state('sensor.llm_assistants_fast_path', state=stats['handled_rate'], attributes=stats)
+
+    def load_response_cache(self):
+        # Answers to repeated questions are reused until an entity or tool they relied on changes
+        self.response_cache = None
+        if not self.args.get('response_cache', True):
+            return
+        self.response_cache = TTLCache(
+            maxsize=self.args.get('response_cache_size', 256),
+            ttl=self.args.get('response_cache_ttl', 60 * 5),
+            on_evict=lambda key, value: self.forget_responses([key]),
+        )
+        self.response_cache_entities = {}  # entity_id -> keys of the responses that read it
+        self.response_cache_deps = {}  # key -> (tools, entities) the response was built from
+        self.response_cache_listeners = {}  # entity_id -> listen_state handle, only while a response reads it
+        self.response_cache_lock = threading.RLock()
+        self.response_cache_invalidated = 0
+        self.assistants['home-assistant'].tool_write_listeners.append(self.response_cache_tool_write)
+
+    def cached_response(self, content, user, thread):
+        if self.response_cache is None:
+            return None
+        start = time.perf_counter()
+        response = self.response_cache.get((normalize_prompt(content), user, thread))
+        if response is not None:
+            self.log_info(f"Reusing cached response for '{content}' ({(time.perf_counter() - start) * 1000:.2f}ms)")
+        self.publish_response_cache_stats()
+        return response
+
+    def cache_response(self, content, user, command, response, thread):
+        """Cache the response of a run that only read the home, keyed by the entities and tools it consulted."""
+        trace = self.assistants['home-assistant'].run_traces.get(thread)
+        if self.response_cache is None or not response or not trace or trace['content'] != command:
+            return  # Merged with other messages, or another run took over the thread
+        tools = {name for name, arguments, output in trace['tool_calls']}
+        if not tools or not tools <= READ_ONLY_TOOLS:
+            return  # Nothing was read from the home, or something in it was changed
+
+        entities = set()
+        for name, arguments, output in trace['tool_calls']:
+            entities.update(
+                entity for entity in re.findall(r'\b[a-z_]+\.[a-z0-9_]+\b', f'{arguments} {output}')
+                if self.entity_exists(entity)
+            )
+        if not entities:
+            return  # Nothing could tell us when the answer goes stale
+
+        # Expired answers stop holding on to their state listeners
+        self.response_cache.expire()
+        key = (normalize_prompt(content), user, thread)
+        with self.response_cache_lock:
+            self.forget_responses([key])
+            self.response_cache.set(key, response)
+            self.response_cache_deps[key] = (tools, entities)
+            for entity in entities:
+                self.response_cache_entities.setdefault(entity, set()).add(key)
+                if entity not in self.response_cache_listeners:
+                    self.response_cache_listeners[entity] = self.listen_state(
+                        self.response_cache_state_changed, entity, attribute='all'
+                    )
+        self.log_info(f"Cached response for '{content}', depends on {len(entities)} entities and tools {sorted(tools)}")
+
+    def forget_responses(self, keys):
+        # Stop listening to the entities no cached response reads any more
+        with self.response_cache_lock:
+            for key in keys:
+                tools, entities = self.response_cache_deps.pop(key, ((), ()))
+                for entity in entities:
+                    readers = self.response_cache_entities.get(entity, set())
+                    readers.discard(key)
+                    if not readers:
+                        self.response_cache_entities.pop(entity, None)
+                        handle = self.response_cache_listeners.pop(entity, None)
+                        if handle is not None:
+                            self.cancel_listen_state(handle)
+
+    def response_cache_state_changed(self, entity, attribute, old, new, kwargs):
+        old, new = old or {}, new or {}
+        if old.get('state') == new.get('state') and old.get('attributes') == new.get('attributes'):
+            return  # Only the timestamps moved
+        with self.response_cache_lock:
+            keys = set(self.response_cache_entities.get(entity, ()))
+        if keys:
+            self.invalidate_responses(keys, f"{entity} changed")
+
+    def response_cache_tool_write(self, name, related):
+        # A tool changed the home, drop the responses built on the reads it makes stale
+        with self.response_cache_lock:
+            keys = [
+                key for key, (tools, entities) in self.response_cache_deps.items()
+                if related is None or tools & set(related)
+            ]
+        if keys:
+            self.invalidate_responses(keys, f"{name} ran")
+
+    def invalidate_responses(self, keys, reason):
+        keys = set(keys)
+        dropped = self.response_cache.invalidate(lambda key, value: key in keys)
+        self.forget_responses(keys)
+        if dropped:
+            self.response_cache_invalidated += dropped
+            self.log_info(f"Dropped {dropped} cached responses, {reason}")
+            self.publish_response_cache_stats()
+
+    def publish_response_cache_stats(self):
+        stats = self.response_cache.stats()
+        stats['invalidated'] = self.response_cache_invalidated
+        stats['tracked_entities'] = len(self.response_cache_listeners)
+        self.set_state('sensor.llm_assistants_response_cache', state=stats['hit_rate'], attributes=stats)
+
+    def send_queued_response(self, future, platform, content=None, user=None, command=None, thread=None):
+        try:
+            response = future.result()
+            if response is ThreadRunCoordinator.MERGED:
+                self.log_info(f"'{content}' was answered together with the earlier messages on {thread}")
+            else:
+                self.cache_response(content, user, command, response, thread)
+                self.log_info(f"Sending response back to {platform} with the following response: {response}")
+                self.fire_event("appdaemon_tool_response", response=response, partial=False)
+        except Exception as e:
+            self.log_info(f"Error: {e}")
+            self.log_info(f"Traceback: {''.join(traceback.format_exception(e))}")
+        self.publish_request_queue_stats()
+        self.publish_tool_stats()
+
+    def publish_request_queue_stats(self):
+        stats = self.request_queue.stats()
+        self.set_state('sensor.llm_assistants_request_queue', state=stats['queued'], attributes=stats)
+
+    def publish_tool_stats(self):
+        assistant = self.assistants['home-assistant']
+        if assistant.tool_subsets:
+            stats = assistant.tool_subset_report()
+            self.set_state('sensor.llm_assistants_tool_subsets', state=stats['too_small_rate'], attributes=stats)
+        if assistant.tool_cache_ttls:
+            stats = assistant.tool_cache_report()
+            self.set_state('sensor.llm_assistants_tool_cache', state=stats['hit_rate'], attributes=stats)
+
+    def send_partial_response(self, text):
+        # Streamed sentences go out as they arrive, the final event still carries the whole response
+        self.fire_event("appdaemon_tool_response", response=text, partial=True)
+
     def attach_vector_store(self, content):
         """Get the most relevant vector store for the user input if any."""
+        # A different set of stores makes every cached decision stale
+        assistant = self.assistants['home-assistant']
+        with assistant.state.lock:
+            stores = tuple(sorted(assistant.stores))
+        if stores != self.routing_cache_stores:
+            self.routing_cache.invalidate()
+            self.routing_cache_stores = stores
+
+        key = normalize_prompt(content)
+        store = self.routing_cache.get(key, default=False)  # None is a valid decision, False marks a miss
+        if store is False:
+            start = time.perf_counter()
+            store = self.vector_store_router.route(content)
+            self.routing_miss_seconds += time.perf_counter() - start
+            self.routing_cache.set(key, store)
+
+        self.publish_routing_cache_stats()
+        return store
+
+    def publish_routing_cache_stats(self):
+        stats = self.routing_cache.stats()
+        misses = self.routing_cache.misses
+        avg_miss_ms = self.routing_miss_seconds * 1000 / misses if misses else 0
+        stats['avg_miss_ms'] = round(avg_miss_ms, 1)
+        stats['saved_ms'] = round(avg_miss_ms * self.routing_cache.hits)
+        self.set_state('sensor.llm_assistants_routing_cache', state=stats['hit_rate'], attributes=stats)
+
+    def llm_vector_store(self, content, stores=None):
+        """Ask the LLM for the most relevant vector store, used when the router is not confident."""
+        stores = stores or list(self.assistants['home-assistant'].stores.keys())
 
         query = f"""
         We have the following vector stores available for you to use:
-        {list(self.assistants['home-assistant'].stores.keys())}
+        {stores}
         
         Please select return the name of the most relevant vector store for the user input:
         
@@ -419,7 +990,7 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
 
         response = self.message_chain.invoke(query)
         self.log(f"Response: {response}")
-        for store in self.assistants['home-assistant'].stores:
+        for store in stores:
             if store in response:
                 return store
 
@@ -480,10 +1051,9 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
     def db_agent(self, db_agent, query):
         try:
             self.log_info(f"Received DB AGENT query: {query}", level='INFO')
-            query_updated = self.fast_api_client.send_request_sync(
-                endpoint="generate_prompt",
-                data={"query": query}
-            )
+            example_sets = self.args.get('db_agent_examples', {'home-db-agent': 'home-database'})
+            query_updated = self.example_index.generate_prompt(query, example_sets[db_agent]) \
+                if db_agent in example_sets else None
             self.log_info(f"""
             Updated Query for DB Agent {db_agent}:
             {query_updated}
@@ -500,6 +1070,7 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
             return f"Error: {e}"
 
     #
+    @serial_tool
     def log_user_preferences(self, user, app, category, preferences, when_to_use):
         user_preference = f"""
         ### User: {user}
@@ -509,7 +1080,8 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
         """
 
         # Define the path to the markdown file
-        app_md_path = f"/conf/assistants/vector_stores/user_preferences/{app}.md"
+        assistant = self.assistants['home-assistant']
+        app_md_path = f"{assistant.assistant_folder}/vector_stores/user_preferences/{app}.md"
         try:
             # Check if the markdown file exists, if not create it
             if not os.path.exists(app_md_path):
@@ -530,9 +1102,8 @@ It is {datetime.now(pytz.timezone('America/Chicago')).strftime('%A, %B %d, %Y')}
                     f.write(user_preference)
                     f.write('\n')
 
-            # Load the updated vector store for each assistant
-            for name, assistant in self.assistants.items():
-                assistant.load_vector_stores("vector_stores")
+            # Push only the updated preference file to the vector store
+            assistant.sync_paths([app_md_path])
         except Exception as e:
             self.log_info(f"Error: {e}")
             self.log_info(f"Traceback: {traceback.format_exc()}")
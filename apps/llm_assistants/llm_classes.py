@@ -1,12 +1,21 @@
+import bisect
+import hashlib
+import inspect
 import json
 import os
+import re
+import threading
 import time
+import zlib
+import numpy as np
 import yaml
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from openai import NotFoundError
 from langchain.agents import Tool, initialize_agent
 from langchain.llms import OpenAI
 from langchain.memory import ChatMessageHistory
-from langchain_community.vectorstores import FAISS
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
 from langchain_core.prompts import (
     ChatPromptTemplate,
     FewShotPromptTemplate,
@@ -21,67 +30,1228 @@ import csv
 import mimetypes
 import html
 import urllib.parse
+from llm_tools import (
+    validate_tool_arguments, ToolArgumentError, get_tools, select_tool_groups, READ_ONLY_TOOL_TTLS,
+    READ_ONLY_TOOLS, TOOL_CACHE_INVALIDATIONS
+)
+from llm_helpers import normalize_prompt, serial_tool, split_sentences, clean_partial, estimate_tokens, serialize_tool_output
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None  # Fall back to mtime polling
+
+class LatencyHistogram:
+    """Thread safe request latency histogram per endpoint with fixed millisecond buckets."""
+
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def observe(self, endpoint, seconds, ok=True):
+        ms = seconds * 1000
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {
+                'counts': [0] * (len(self.buckets) + 1), 'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+            })
+            entry['counts'][bisect.bisect_left(self.buckets, ms)] += 1
+            entry['count'] += 1
+            entry['errors'] += not ok
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+
+    def percentile(self, counts, count, q):
+        # Upper bound of the bucket holding the q-th request, the overflow bucket reports as inf
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            seen += bucket_count
+            if seen >= q * count:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        with self.lock:
+            report = {}
+            for endpoint, entry in self.endpoints.items():
+                count = entry['count']
+                labels = [f'<={bound}ms' for bound in self.buckets] + [f'>{self.buckets[-1]}ms']
+                report[endpoint] = {
+                    'count': count,
+                    'errors': entry['errors'],
+                    'avg_ms': round(entry['total_ms'] / count, 1),
+                    'max_ms': round(entry['max_ms'], 1),
+                    'p50_ms': self.percentile(entry['counts'], count, 0.5),
+                    'p95_ms': self.percentile(entry['counts'], count, 0.95),
+                    'buckets': {label: n for label, n in zip(labels, entry['counts']) if n},
+                }
+            return report
+
 
 class FastAPIClient:
-    def __init__(self, base_url):
-        self.base_url = base_url
+    """Client for the local FastAPI service that keeps its connections open between requests.
+
+    One pooled httpx.Client serves every call, so a request no longer pays for a new event loop and a TCP
+    handshake. Connection errors, timeouts, 429 and 5xx responses are retried with exponential backoff up to
+    `retries` times.
+    """
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, logger, timeout=10.0, connect_timeout=3.0, max_connections=10,
+                 max_keepalive_connections=5, keepalive_expiry=30.0, retries=2, backoff=0.25):
+        self.base_url = base_url.rstrip('/')
+        self.log_info = logger
+        self.retries = retries
+        self.backoff = backoff
+        self.latency = LatencyHistogram()
+        self.client = httpx.Client(
+            base_url=self.base_url,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+        )
 
-    async def send_request(self, endpoint, data):
-        async with httpx.AsyncClient() as client:
+    def should_retry(self, error, attempt):
+        if attempt >= self.retries:
+            return False
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code in self.retry_statuses
+        return isinstance(error, (httpx.TransportError, httpx.TimeoutException))
+
+    def post(self, endpoint, data):
+        attempt = 0
+        while True:
+            start = time.perf_counter()
             try:
-                response = await client.post(f"{self.base_url}/{endpoint}", json=data)
+                response = self.client.post(f"/{endpoint}", json=data)
                 response.raise_for_status()
-                return response.json()['command']
-            except httpx.HTTPStatusError as e:
-                print(f"HTTP error occurred: {e.response.status_code}")
-                print(f"Response content: {e.response.text}")
-                return ''
+                self.latency.observe(endpoint, time.perf_counter() - start)
+                return response.json()
             except Exception as e:
-                print(f"An error occurred: {e}")
+                self.latency.observe(endpoint, time.perf_counter() - start, ok=False)
+                if not self.should_retry(e, attempt):
+                    raise
+                attempt += 1
+                self.log_info(f"Retrying {endpoint} ({attempt}/{self.retries}) after: {e}")
+                time.sleep(self.backoff * 2 ** (attempt - 1))
 
     def send_request_sync(self, endpoint, data):
-        return asyncio.run(self.send_request(endpoint, data))
+        try:
+            return self.post(endpoint, data)['command']
+        except httpx.HTTPStatusError as e:
+            self.log_info(f"HTTP error occurred on {endpoint}: {e.response.status_code}")
+            self.log_info(f"Response content: {e.response.text}")
+            return ''
+        except Exception as e:
+            self.log_info(f"An error occurred on {endpoint}: {e}")
+            return None
+
+    def latency_report(self):
+        return self.latency.snapshot()
+
+    def close(self):
+        self.client.close()
+
+
+class TTLCache:
+    """Thread safe LRU cache with an optional time to live per entry and hit/miss counters."""
+
+    def __init__(self, maxsize=256, ttl=None, sliding=False, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sliding = sliding  # Reset the time to live on every hit (idle expiry)
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        evicted = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                evicted.append((key, self.entries.pop(key)[1]))
+                entry = None
+            if entry is None:
+                self.misses += 1
+                value = default
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                value = entry[1]
+                if self.sliding and entry[0] is not None:
+                    self.entries[key] = (time.monotonic() + entry[2], value, entry[2])
+        self.evicted(evicted)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        evicted = []
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl if ttl else None, value, ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                oldest = next(iter(self.entries))
+                evicted.append((oldest, self.entries.pop(oldest)[1]))
+        self.evicted(evicted)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __getitem__(self, key):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def invalidate(self, predicate=None):
+        """Drop every entry, or only those where predicate(key, value) is true. Returns how many were dropped."""
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if predicate is None or predicate(key, entry[1])]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            evicted = [
+                (key, entry[1]) for key, entry in self.entries.items() if entry[0] is not None and entry[0] <= now
+            ]
+            for key, value in evicted:
+                del self.entries[key]
+        self.evicted(evicted)
+
+    def evicted(self, evicted):
+        # Callbacks run outside the lock, they may call out to the network
+        self.evictions += len(evicted)
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def items(self):
+        with self.lock:
+            return [(key, entry[1]) for key, entry in self.entries.items()]
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (entry[0] is None or entry[0] > time.monotonic())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+            'evictions': self.evictions,
+        }
+
+
+class ThreadRunCoordinator:
+    """Serializes runs per conversation thread and folds messages that arrive during a run into the next one."""
+
+    # Returned to the callers whose message was answered by someone else's merged run
+    MERGED = object()
+
+    def __init__(self, wait_timeout=300):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.active = set()
+        self.wait_timeout = wait_timeout
+
+    def queue(self, key, payload, done):
+        ticket = {'payload': payload, 'done': done, 'lead': False, 'response': None, 'error': None}
+        with self.lock:
+            self.pending.setdefault(key, []).append(ticket)
+            if key not in self.active:
+                # Nothing running on this thread, this message starts the next run
+                self.active.add(key)
+                ticket['lead'] = True
+        return ticket
+
+    def take_batch(self, key):
+        with self.lock:
+            return self.pending.pop(key, [])
+
+    def finish_batch(self, key, batch):
+        with self.lock:
+            for ticket in batch:
+                ticket['lead'] = False
+                ticket['done'].set()
+            # Whoever queued first while the run was active leads the next, merged run
+            waiting = self.pending.get(key)
+            if waiting:
+                waiting[0]['lead'] = True
+                waiting[0]['done'].set()
+            else:
+                self.active.discard(key)
+
+    def give_up(self, key, ticket):
+        """Stop waiting for a run, returns False when the ticket was woken up in the meantime."""
+        with self.lock:
+            if ticket['done'].is_set():
+                return False
+            waiting = self.pending.get(key, [])
+            # Still queued, leave the next run to the others. Otherwise the running batch simply drops it
+            waiting[:] = [queued for queued in waiting if queued is not ticket]
+            if not waiting:
+                self.pending.pop(key, None)
+        ticket['error'] = TimeoutError(f"Gave up after {self.wait_timeout}s waiting for the run on thread {key}")
+        return True
+
+    def deliver(self, ticket, batch, response=None, error=None):
+        for queued in batch:
+            queued['error'] = error
+            # The merged answer goes out once, through the message that ran it
+            queued['response'] = response if queued is ticket else self.MERGED
+
+    @staticmethod
+    def result(ticket):
+        if ticket['error'] is not None:
+            raise ticket['error']
+        return ticket['response']
+
+    def run(self, key, payload, runner):
+        """Run runner([payloads]) for this message, or wait for the run it was merged into."""
+        ticket = self.queue(key, payload, threading.Event())
+        if not ticket['lead'] and not ticket['done'].wait(self.wait_timeout) and self.give_up(key, ticket):
+            return self.result(ticket)
+        if ticket['lead']:
+            batch = self.take_batch(key)
+            try:
+                self.deliver(ticket, batch, response=runner([queued['payload'] for queued in batch]))
+            except Exception as e:
+                self.deliver(ticket, batch, error=e)
+            self.finish_batch(key, batch)
+        return self.result(ticket)
+
+    async def arun(self, key, payload, runner):
+        """Coroutine version of run for the event loop engine."""
+        ticket = self.queue(key, payload, asyncio.Event())
+        if not ticket['lead']:
+            try:
+                await asyncio.wait_for(ticket['done'].wait(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                if self.give_up(key, ticket):
+                    return self.result(ticket)
+        if ticket['lead']:
+            batch = self.take_batch(key)
+            try:
+                self.deliver(ticket, batch, response=await runner([queued['payload'] for queued in batch]))
+            except Exception as e:
+                self.deliver(ticket, batch, error=e)
+            self.finish_batch(key, batch)
+        return self.result(ticket)
+
+
+class ApiCallCounter:
+    """httpx request hook that counts the OpenAI API calls per endpoint."""
+
+    id_pattern = re.compile(r'/(?:asst|vs|thread|run|msg|step|vsfb)_[A-Za-z0-9]+|/file-[A-Za-z0-9]+')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def __call__(self, request):
+        # Collapse object ids so calls are grouped by endpoint
+        endpoint = f"{request.method} {self.id_pattern.sub('/{id}', request.url.path)}"
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    async def async_hook(self, request):
+        # httpx.AsyncClient only accepts coroutine event hooks
+        self(request)
+
+    def total(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.calls)
+
+
+class AssistantState:
+    """Persisted snapshot of an assistant's remote ids and file manifest used to warm start after a restart."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {
+            'assistant_id': None,
+            'stores': {},
+            'threads': {},
+            'manifest': {},
+        }
+        # Stores sync concurrently, every mutation of the snapshot goes through this lock
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        # Write to a temp file first so a crash never leaves a half written state file
+        with self.lock:
+            content = json.dumps(self.data, indent=2, sort_keys=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(content)
+            os.replace(tmp_path, self.path)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+
+class VectorStoreManifest:
+    """Local record of path -> content hash -> remote file id for every vector store."""
+
+    def __init__(self, state):
+        self.state = state
+        self.stores = state['manifest']
+
+    def save(self):
+        self.state.save()
+
+    def has_store(self, store):
+        return store in self.stores
+
+    def entries(self, store):
+        with self.state.lock:
+            return self.stores.setdefault(store, {})
+
+    def files(self, store):
+        """Copy of a store's entries, without creating the store like entries() does."""
+        with self.state.lock:
+            return dict(self.stores.get(store, {}))
+
+    def drop_store(self, store):
+        with self.state.lock:
+            self.stores.pop(store, None)
+
+    def set(self, store, path, file_hash, file_id):
+        stat = os.stat(path)
+        with self.state.lock:
+            self.entries(store)[path] = {
+                'hash': file_hash,
+                'file_id': file_id,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+            }
+
+    def remove(self, store, path):
+        with self.state.lock:
+            return self.entries(store).pop(path, None)
+
+    @staticmethod
+    def hash_file(file_path):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def diff(self, store, file_paths, scope=None):
+        """Compare the files on disk with the manifest and bucket them into added, changed, removed and skipped.
+
+        When a scope of touched paths is given only manifest entries under those paths can be reported as removed.
+        """
+        known = self.entries(store)
+        added, changed, skipped = {}, {}, []
+        for path in file_paths:
+            entry = known.get(path)
+            try:
+                stat = os.stat(path)
+                # Size and mtime unchanged means the content is unchanged, no need to hash the file
+                if entry and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime_ns:
+                    skipped.append(path)
+                    continue
+                file_hash = self.hash_file(path)
+            except OSError:
+                continue
+
+            if entry is None:
+                added[path] = file_hash
+            elif entry['hash'] != file_hash:
+                changed[path] = file_hash
+            else:
+                # Touched but identical, refresh the stat info so the next sync can skip hashing
+                self.set(store, path, file_hash, entry['file_id'])
+                skipped.append(path)
+
+        file_paths = set(file_paths)
+        with self.state.lock:
+            removed = [
+                path for path in known
+                if path not in file_paths and (scope is None or self.in_scope(path, scope))
+            ]
+        return added, changed, removed, skipped
+
+    @staticmethod
+    def in_scope(path, scope):
+        return any(path == touched or path.startswith(f"{touched}{os.sep}") for touched in scope)
+
+
+class KnowledgeWatcher:
+    """Watches the knowledge folders and hands debounced batches of touched paths to a callback."""
+
+    def __init__(self, folders, callback, logger, debounce=5, poll_interval=30, use_inotify=True):
+        self.folders = folders
+        self.callback = callback
+        self.log_info = logger
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and INotify is not None
+        self.pending = set()
+        self.last_touch = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        target = self.watch_inotify if self.use_inotify else self.watch_polling
+        self.thread = threading.Thread(target=target, name='knowledge-watcher', daemon=True)
+        self.thread.start()
+        self.log_info(f"Watching {self.folders} using {'inotify' if self.use_inotify else 'mtime polling'}")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def touch(self, path):
+        with self.lock:
+            self.pending.add(path)
+            self.last_touch = time.monotonic()
+
+    def flush(self):
+        # Wait until the burst of edits settles before syncing
+        with self.lock:
+            if not self.pending or time.monotonic() - self.last_touch < self.debounce:
+                return
+            paths, self.pending = self.pending, set()
+        try:
+            self.callback(sorted(paths))
+        except Exception as e:
+            self.log_info(f"Failed to sync touched files: {e}")
+
+    def watch_inotify(self):
+        inotify = INotify()
+        mask = (flags.CREATE | flags.CLOSE_WRITE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO
+                | flags.DELETE_SELF)
+        watches = {}
+
+        def add_watches(folder):
+            # inotify is not recursive, every sub folder needs its own watch
+            for root, dirs, files in os.walk(folder):
+                try:
+                    watches[inotify.add_watch(root, mask)] = root
+                except OSError as e:
+                    self.log_info(f"Failed to watch {root} - {e}")
+
+        for folder in self.folders:
+            if os.path.isdir(folder):
+                add_watches(folder)
+
+        while not self.stop_event.is_set():
+            for event in inotify.read(timeout=1000):
+                if event.mask & flags.IGNORED:
+                    watches.pop(event.wd, None)
+                    continue
+                folder = watches.get(event.wd)
+                if folder is None or not event.name:
+                    continue
+                path = os.path.join(folder, event.name)
+                if event.mask & flags.ISDIR and event.mask & (flags.CREATE | flags.MOVED_TO):
+                    add_watches(path)
+                self.touch(path)
+            self.flush()
+
+    def watch_polling(self):
+        snapshot = self.scan()
+        last_scan = time.monotonic()
+        while not self.stop_event.wait(1):
+            if time.monotonic() - last_scan >= self.poll_interval:
+                current = self.scan()
+                for path in current.keys() | snapshot.keys():
+                    if current.get(path) != snapshot.get(path):
+                        self.touch(path)
+                snapshot, last_scan = current, time.monotonic()
+            self.flush()
+
+    def scan(self):
+        files = {}
+        for folder in self.folders:
+            for root, dirs, names in os.walk(folder):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files[path] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+
+class OpenAIFileIndex:
+    """In-memory index of the OpenAI files and vector store files, fully paginated and built once per sync."""
+
+    def __init__(self, client):
+        self.client = client
+        self.by_id = {}
+        self.by_filename = {}
+        self.store_files = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        with self.lock:
+            self.by_id = {}
+            self.by_filename = {}
+            self.store_files = {}
+            # Iterating the page object follows the pagination cursor through every page
+            for file in self.client.files.list():
+                self.add(file)
+            self.loaded = True
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                self.refresh()
+
+    def invalidate(self):
+        # Rebuilt lazily on the next lookup so a sync with nothing to do makes no listing calls
+        with self.lock:
+            self.loaded = False
+            self.store_files = {}
+
+    def add(self, file):
+        with self.lock:
+            self.by_id[file.id] = file
+            self.by_filename.setdefault(file.filename, {})[file.id] = file
+
+    def remove(self, file_id):
+        with self.lock:
+            file = self.by_id.pop(file_id, None)
+            if file is not None:
+                same_name = self.by_filename.get(file.filename, {})
+                same_name.pop(file_id, None)
+                if not same_name:
+                    self.by_filename.pop(file.filename, None)
+            for file_ids in self.store_files.values():
+                file_ids.discard(file_id)
+
+    def get(self, file_id):
+        self.ensure_loaded()
+        file = self.by_id.get(file_id)
+        if file is None:
+            # Files generated during a run are newer than the index, fetch and remember them
+            try:
+                file = self.client.files.retrieve(file_id)
+            except NotFoundError:
+                return None
+            self.add(file)
+        return file
+
+    def find(self, filename, vector_store_id=None):
+        self.ensure_loaded()
+        with self.lock:
+            files = list(self.by_filename.get(filename, {}).values())
+        if vector_store_id:
+            store_file_ids = self.vector_store_file_ids(vector_store_id)
+            files = [file for file in files if file.id in store_file_ids]
+        return files
+
+    def vector_store_file_ids(self, vector_store_id):
+        with self.lock:
+            if vector_store_id in self.store_files:
+                return self.store_files[vector_store_id]
+        # List outside the lock so other stores are not blocked behind the pagination
+        file_ids = {
+            file.id for file in self.client.beta.vector_stores.files.list(
+                vector_store_id=vector_store_id, limit=100
+            )
+        }
+        with self.lock:
+            return self.store_files.setdefault(vector_store_id, file_ids)
+
+    def attach(self, vector_store_id, file_ids):
+        with self.lock:
+            if vector_store_id in self.store_files:
+                self.store_files[vector_store_id].update(file_ids)
+
+    def detach(self, vector_store_id, file_id):
+        with self.lock:
+            if vector_store_id in self.store_files:
+                self.store_files[vector_store_id].discard(file_id)
+
+
+class HashingEmbedder:
+    """Deterministic offline embedder, hashes words and word pairs into a fixed size vector."""
+
+    stop_words = {
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'for', 'from', 'how', 'i', 'in', 'is', 'it',
+        'me', 'my', 'of', 'on', 'or', 'please', 'the', 'this', 'to', 'what', 'when', 'with', 'you', 'your',
+    }
+
+    def __init__(self, dimensions=1024, signed=False):
+        self.dimensions = dimensions
+        # Signed buckets can push a real match below zero when an unrelated word collides with it
+        self.signed = signed
+
+    def tokens(self, text):
+        words = [word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in self.stop_words]
+        # Fold plurals so 'lights' and 'light' land in the same bucket
+        words = [word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+                 for word in words]
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in self.tokens(text):
+                # crc32 is stable across processes, unlike hash()
+                bucket = zlib.crc32(token.encode())
+                sign = -1.0 if self.signed and not bucket & 0x80000000 else 1.0
+                vectors[row, bucket % self.dimensions] += sign
+        return normalize_rows(vectors)
+
+
+class OpenAIEmbedder:
+    """Embeds with the OpenAI embeddings endpoint, in batches."""
+
+    def __init__(self, client, model='text-embedding-3-small', batch_size=256):
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+
+    def embed(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            response = self.client.embeddings.create(model=self.model, input=texts[i:i + self.batch_size])
+            vectors.extend(item.embedding for item in response.data)
+        return normalize_rows(np.array(vectors, dtype=np.float32))
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorStoreRouter:
+    """Picks the vector store most similar to a prompt from its description and its closest file."""
+
+    def __init__(self, embedder, min_score=0.06, min_margin=0.02, description_weight=0.5, fallback=None,
+                 max_chars=4000, logger=print):
+        self.embedder = embedder
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.description_weight = description_weight
+        self.fallback = fallback
+        self.max_chars = max_chars
+        self.log_info = logger
+        self.names = []
+        self.descriptions = None
+        self.store_files = []
+        self.file_vectors = {}
+        self.description_vectors = {}
+        self.signature = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()  # One build at a time, routing keeps using the last snapshot meanwhile
+
+    @staticmethod
+    def file_title(path):
+        # File names often say more than the notes inside them, e.g. air_quality.md
+        return os.path.splitext(os.path.basename(path))[0].replace('_', ' ').replace('-', ' ')
+
+    def build(self, stores, signature=None):
+        """Build the store vectors from {store: {'description': str, 'files': {path: content hash}}}."""
+        with self.build_lock:
+            if signature is not None and signature == self.signature:
+                return False
+            start = time.perf_counter()
+            wanted = {key for store in stores.values() for key in store.get('files', {}).items()}
+            # Only files with an unseen path and content hash are read and embedded, edited files drop the old vector
+            self.file_vectors = {key: vector for key, vector in self.file_vectors.items() if key in wanted}
+            missing = [key for key in wanted if key not in self.file_vectors]
+            if missing:
+                texts = []
+                for path, file_hash in missing:
+                    try:
+                        with open(path, 'r', errors='ignore') as f:
+                            texts.append(f"{self.file_title(path)}\n{f.read(self.max_chars)}")
+                    except OSError:
+                        texts.append(self.file_title(path))
+                self.file_vectors.update(zip(missing, self.embedder.embed(texts)))
+
+            descriptions = [store.get('description', '') for store in stores.values()]
+            new_descriptions = [text for text in dict.fromkeys(descriptions) if text not in self.description_vectors]
+            if new_descriptions:
+                self.description_vectors.update(zip(new_descriptions, self.embedder.embed(new_descriptions)))
+            self.description_vectors = {text: self.description_vectors[text] for text in descriptions}
+
+            store_files = [
+                np.array([self.file_vectors[key] for key in store.get('files', {}).items()], dtype=np.float32)
+                for store in stores.values()
+            ]
+            description_matrix = np.array(
+                [self.description_vectors[text] for text in descriptions], dtype=np.float32
+            ) if stores else None
+            # Routing reads the previous snapshot until this swap
+            with self.lock:
+                self.names = list(stores)
+                self.descriptions = description_matrix
+                self.store_files = store_files
+                self.signature = signature
+        self.log_info(f"Vector Store router built for {self.names}, embedded {len(missing)} files "
+                      f"in {(time.perf_counter() - start) * 1000:.0f}ms")
+        return True
+
+    def scores(self, content):
+        with self.lock:
+            names, descriptions, store_files = self.names, self.descriptions, self.store_files
+        if descriptions is None:
+            return {}
+        query = self.embedder.embed([content])[0]
+        scores = {}
+        for name, description, files in zip(names, descriptions @ query, store_files):
+            if len(files):
+                # The closest file counts, a centroid would dilute one relevant note among many
+                best_file = float((files @ query).max())
+                scores[name] = self.description_weight * float(description) + (1 - self.description_weight) * best_file
+            else:
+                scores[name] = float(description)
+        return scores
+
+    def route(self, content):
+        """Return the most relevant store name, or None when nothing is relevant enough."""
+        start = time.perf_counter()
+        scores = sorted(self.scores(content).items(), key=lambda item: item[1], reverse=True)
+        if not scores:
+            return None
+
+        best, best_score = scores[0]
+        margin = best_score - scores[1][1] if len(scores) > 1 else best_score
+        plausible = [name for name, score in scores if score >= self.min_score and best_score - score < self.min_margin]
+        store, source = None, 'none'
+        if best_score < self.min_score:
+            pass  # Unrelated to every store, no vector store is attached
+        elif len(plausible) > 1 and self.fallback:
+            # Close call between stores that both match, let the fallback pick one of them
+            store, source = self.fallback(content, plausible), 'fallback'
+        else:
+            store, source = best, 'embedding'
+
+        self.log_info(
+            f"Routed to {store} via {source} in {(time.perf_counter() - start) * 1000:.1f}ms "
+            f"(best {best}={best_score:.3f}, margin {margin:.3f})"
+        )
+        return store
+
+
+class ExampleIndex:
+    """Few shot examples from the assistants' examples YAML, embedded once and searched in memory."""
+
+    def __init__(self, folders, embedder, cache_path, logger=print):
+        self.folders = folders
+        self.embedder = embedder
+        self.cache_path = cache_path
+        self.log_info = logger
+        self.sets = {}  # example set -> {'system_prompt', 'example_prompt'}
+        self.examples = []  # {'set', 'input', 'text'}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def yaml_files(self):
+        return sorted(
+            os.path.join(folder, name)
+            for folder in self.folders if os.path.isdir(folder)
+            for name in os.listdir(folder) if name.endswith(('.yaml', '.yml'))
+        )
+
+    def signature(self, files):
+        embedder = (type(self.embedder).__name__, getattr(self.embedder, 'model', None),
+                    getattr(self.embedder, 'dimensions', None), getattr(self.embedder, 'signed', None))
+        digest = hashlib.sha256(f'{embedder}'.encode())
+        for path in files:
+            digest.update(path.encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def load(self):
+        """Reuse the index saved on disk unless the YAML or the embedder changed since it was built."""
+        start = time.perf_counter()
+        files = self.yaml_files()
+        signature = self.signature(files)
+        if os.path.exists(self.cache_path):
+            try:
+                with np.load(self.cache_path) as cache:
+                    meta = json.loads(str(cache['meta']))
+                    if meta['signature'] == signature:
+                        self.sets, self.examples, self.vectors = meta['sets'], meta['examples'], cache['vectors']
+                        self.log_info(f"Loaded {len(self.examples)} examples from {self.cache_path} "
+                                      f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+                        return
+            except Exception as e:
+                self.log_info(f"Rebuilding the example index, the saved one could not be read - {e}")
+
+        self.sets, self.examples = {}, []
+        for path in files:
+            with open(path, 'r') as f:
+                data = yaml.safe_load(f) or {}
+            example_set = os.path.splitext(os.path.basename(path))[0]
+            example_prompt = data.get('example_prompt', "User input: {input}\n{query}")
+            self.sets[example_set] = {'system_prompt': data.get('system_prompt', ''), 'example_prompt': example_prompt}
+            for example in data.get('examples') or []:
+                self.examples.append({
+                    'set': example_set,
+                    'input': example.get('input', ''),
+                    'text': example_prompt.format(input=example.get('input', ''), query=example.get('query', '')),
+                })
+        self.vectors = self.embedder.embed([example['input'] for example in self.examples]) \
+            if self.examples else np.zeros((0, 0), dtype=np.float32)
+
+        meta = json.dumps({'signature': signature, 'sets': self.sets, 'examples': self.examples})
+        tmp_path = f'{self.cache_path}.tmp.npz'
+        np.savez(tmp_path, vectors=self.vectors, meta=np.array(meta))
+        os.replace(tmp_path, self.cache_path)
+        self.log_info(f"Built the example index of {len(self.examples)} examples from {len(files)} files "
+                      f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    def select(self, query, example_set=None, k=3, min_score=0.0):
+        """The k examples closest to the query, optionally only from one example set."""
+        if not self.examples:
+            return []
+        scores = self.vectors @ self.embedder.embed([query])[0]
+        if example_set:
+            scores = np.where([example['set'] == example_set for example in self.examples], scores, -np.inf)
+        top = np.argsort(-scores)[:k]
+        return [self.examples[i] for i in top if np.isfinite(scores[i]) and scores[i] >= min_score]
+
+    def examples_text(self, query, example_set=None, k=3, min_score=0.0):
+        return '\n\n'.join(example['text'] for example in self.select(query, example_set, k, min_score))
+
+    def generate_prompt(self, query, example_set, k=3):
+        """System prompt, the closest examples and the query, like the old generate_prompt endpoint."""
+        start = time.perf_counter()
+        examples = self.examples_text(query, example_set, k)
+        if not examples:
+            return None
+        system_prompt = self.sets[example_set]['system_prompt']
+        prompt = self.sets[example_set]['example_prompt'].split('{query}')[0].format(input=query)
+        self.log_info(f"Selected {example_set} examples in {(time.perf_counter() - start) * 1000:.2f}ms")
+        return f"{system_prompt}\n\nEXAMPLES:\n\n{examples}\n\n{prompt}"
+
+
+class LocalCommandMatcher:
+    """Matches simple on/off device commands without a model run, anything it is not sure about returns None."""
+
+    actions = {'on': 'turn_on', 'off': 'turn_off'}
+    filler = {
+        'turn', 'switch', 'the', 'in', 'at', 'please', 'all', 'can', 'could', 'would', 'you', 'hey', 'now', 'my',
+        'our', 'go', 'ahead', 'and', 'thanks', 'thank',
+    }
+    negations = {'not', "don't", 'dont', 'never', 'no', "didn't", 'didnt', 'why', 'what', 'is', 'are', 'if'}
+
+    def __init__(self, controllable, master_apps=()):
+        self.rooms = {}  # spoken room name -> room key
+        self.targets = {}  # (room, device) -> [(tool name, arguments)]
+        self.masters = {}  # (room, app) -> arguments of the app's own master automation
+        for app, rooms in controllable.items():
+            for room, entities in rooms.items():
+                self.rooms[self.spoken(room)] = room
+                if app in master_apps:
+                    self.masters[(room, self.device(app))] = {'app': app, 'room': room, 'override': True}
+                for entity_type, entity in entities.items():
+                    entity_ids = [entity] if isinstance(entity, str) else entity
+                    if not entity_ids or not isinstance(entity_ids, (list, tuple, set)):
+                        continue
+                    domains = {f'{entity_id}'.split('.')[0] for entity_id in entity_ids}
+                    if len(domains) != 1:
+                        continue  # Mixed domains need more care than a single command
+                    self.add_target(room, entity_type, 'command_matching_entities', {
+                        'domain': domains.pop(),
+                        'pattern': '|'.join(re.escape(f'{entity_id}') for entity_id in sorted(entity_ids)),
+                        'area': room,
+                    })
+
+    @staticmethod
+    def spoken(name):
+        return normalize_prompt(f'{name}'.replace('_', ' '))
+
+    @classmethod
+    def device(cls, name):
+        # Fold plurals so 'lights' and 'light' name the same device
+        return ' '.join(word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+                        for word in cls.spoken(name).split())
+
+    def add_target(self, room, device, name, args):
+        self.targets.setdefault((room, self.device(device)), []).append((name, args))
+
+    def match(self, content):
+        """Return (tool name, arguments, reply) for a confident match, None otherwise."""
+        words = normalize_prompt(content).split()
+        if not words or self.negations.intersection(words):
+            return None
+
+        actions = {self.actions[word] for word in words if word in self.actions}
+        if len(actions) != 1:
+            return None
+        action = actions.pop()
+
+        # Exactly one room, the longest name wins so 'living room' beats 'room'
+        text = f" {' '.join(words)} "
+        rooms = [spoken for spoken in self.rooms if f' {spoken} ' in text]
+        rooms = [spoken for spoken in rooms if not any(spoken != other and spoken in other for other in rooms)]
+        if len(rooms) != 1:
+            return None
+        room = self.rooms[rooms[0]]
+
+        # Whatever is left has to name exactly one device of that room
+        remaining = text.replace(f' {rooms[0]} ', ' ').split()
+        remaining = [word for word in remaining if word not in self.filler and word not in self.actions]
+        device = self.device(' '.join(remaining))
+        if (room, device) in self.masters:
+            # Naming the app itself ('office lights') runs its master automation for the room
+            name = 'run_master_on_automation' if action == 'turn_on' else 'run_master_off_automation'
+            args = self.masters[(room, device)]
+        else:
+            targets = self.targets.get((room, device), [])
+            if len(targets) != 1:
+                return None
+            name, args = targets[0]
+            args = {'hacs_commands': action, **args}
+        reply = f"Okay, turning {'on' if action == 'turn_on' else 'off'} the {rooms[0]} {' '.join(remaining)}."
+        return name, args, reply
+
+
+class InstructionBuilder:
+    """Assembles the dynamic instructions from sections, re-rendering only the ones whose data changed."""
+
+    def __init__(self, logger=print, token_counter=estimate_tokens, token_budget=None):
+        self.log_info = logger
+        self.token_counter = token_counter
+        self.token_budget = token_budget
+        self.sections = {}  # key -> (hash of the source data, rendered text, tokens, baseline tokens)
+        self.text = ''
+        self.tokens = 0
+        self.baseline_tokens = 0
+        self.fingerprint = None
+
+    @staticmethod
+    def hash(data):
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def build(self, sections):
+        """Sections are (key, data, render) in output order, returns True when the text changed.
+
+        A fourth element, the render of the verbose encoding, is only used to report how much was saved.
+        """
+        start = time.perf_counter()
+        parts, rendered = [], []
+        self.tokens = self.baseline_tokens = 0
+        for key, data, render, *baseline in sections:
+            data_hash = self.hash(data)
+            cached = self.sections.get(key)
+            if cached is None or cached[0] != data_hash:
+                text = render(data)
+                tokens = self.token_counter(text)
+                baseline_tokens = self.token_counter(baseline[0](data)) if baseline else tokens
+                cached = self.sections[key] = (data_hash, text, tokens, baseline_tokens)
+                rendered.append(key)
+            parts.append(cached[1])
+            self.tokens += cached[2]
+            self.baseline_tokens += cached[3]
+
+        # Drop the sections of apps that are gone
+        keys = {key for key, *section in sections}
+        for key in [key for key in self.sections if key not in keys]:
+            del self.sections[key]
+
+        self.text = ''.join(parts)
+        fingerprint = self.hash(self.text)
+        changed = fingerprint != self.fingerprint
+        self.fingerprint = fingerprint
+        self.log_info(
+            f"Dynamic instructions {'changed' if changed else 'unchanged'}: {len(self.text)} chars, "
+            f"~{self.tokens} tokens (~{self.baseline_tokens} verbose), "
+            f"rendered {len(rendered)}/{len(sections)} sections {rendered} in {(time.perf_counter() - start) * 1000:.1f}ms"
+        )
+        if self.token_budget and self.tokens > self.token_budget:
+            largest = sorted(self.sections.items(), key=lambda item: item[1][2], reverse=True)[:3]
+            self.log_info(
+                f"WARNING: Dynamic instructions use ~{self.tokens} tokens, over the budget of {self.token_budget}. "
+                f"Largest sections: {[(key, section[2]) for key, section in largest]}"
+            )
+        return changed
 
 
 class Assistant:
-    def __init__(self, client, assistant_name, tools, tool_funcs, model, dynamic_instructions, logger):
+    def __init__(self, client, assistant_name, tools, tool_funcs, model, dynamic_instructions, logger,
+                 api_calls=None, warm_start=True, sync_concurrency=4, upload_concurrency=8, tool_concurrency=8, serial_tools=None,
+                 stream_responses=False, max_threads=32, thread_idle_ttl=60 * 30, lazy_sync=True,
+                 assistant_model=None, tool_subsets=False, tool_cache_ttls=None, tool_output_limits=None,
+                 merge_wait_timeout=300):
         self.client = client
         self.assistant_name = assistant_name
         self.assistant = False
         self.log_info = logger
         self.model = model
+        self.assistant_model = assistant_model
         self.tool_funcs = tool_funcs
         self.tool_funcs['generate_image'] = self.generate_image
+        self.serial_tools = set(serial_tools or [])
+        self.stream_responses = stream_responses
+        self.tool_subsets = tool_subsets
+        self.tool_subset_stats = Counter()
+        # Read only tool results are reused for a few seconds, within a run and across follow up turns
+        self.tool_cache_ttls = READ_ONLY_TOOL_TTLS if tool_cache_ttls is None else tool_cache_ttls
+        self.tool_cache = TTLCache(maxsize=512)
+        self.tool_cache_stats = Counter()
+        # Characters each tool output may take in the next model step, per tool name or 'default'
+        self.tool_output_limits = {'default': 4000, **(tool_output_limits or {})}
+        # The tools each thread's last run called, and callbacks told when a tool changed the home
+        self.run_traces = {}
+        self.tool_write_listeners = []
+        # Callbacks run in the sync thread after every sync, e.g. to rebuild what depends on the stores
+        self.sync_listeners = []
+        self.run_coordinator = ThreadRunCoordinator(wait_timeout=merge_wait_timeout)
+        self.tool_executor = ThreadPoolExecutor(max_workers=max(1, tool_concurrency),
+                                                thread_name_prefix=f'{assistant_name}-tools')
         self.assistant_folder = f'/conf/assistants/{self.assistant_name}'
         # self.fast_api_client = FastAPIClient("http://localhost:8000")
-        self.base_instructions = self.build_instructions()
-        self.base_instructions += dynamic_instructions
+        self.dynamic_instructions = dynamic_instructions
+        self.base_instructions = ''
         self.tools = self.build_tools(tools)
         self.user_files = {}
         self.files = {}
+        self.stores = {}
+        # Conversations expire after thread_idle_ttl seconds idle, the least recently used go first past max_threads
+        self.threads = TTLCache(maxsize=max_threads, ttl=thread_idle_ttl, sliding=True,
+                                on_evict=self.thread_evicted)
+        self.api_calls = api_calls
+        self.warm_start = warm_start
+        self.sync_concurrency = sync_concurrency
+        self.upload_concurrency = upload_concurrency
+        self.sync_status = {}
+        self.sync_lock = threading.Lock()
+        self.sync_generation = 0
+        self.lazy_sync = lazy_sync
+        self.sync_thread = None
+        self.state = AssistantState(f'{self.assistant_folder}/.assistant_state.json')
+        self.file_index = OpenAIFileIndex(self.client)
+        self.manifest = VectorStoreManifest(self.state)
         self.initialize()
 
     def initialize(self):
-        self.load_assistant()
-        self.load_vector_stores()
-        self.create_thread()
+        start = time.perf_counter()
+        api_calls = self.api_calls.total() if self.api_calls else None
+        self.startup_stats = {'warm_start': self.warm_start, 'lazy_sync': self.lazy_sync, 'phases': {}}
+
+        self.timed('instructions', self.load_instructions)
+        self.timed('assistant_update', self.load_assistant)
+        self.timed('thread_creation', self.create_thread)
+        if self.lazy_sync:
+            # Answer with the stores from the last run while the sync catches up in the background
+            self.restore_vector_stores()
+            self.sync_thread = threading.Thread(
+                target=self.timed, args=('store_sync', self.load_vector_stores),
+                name=f'{self.assistant_name}-startup-sync', daemon=True
+            )
+            self.sync_thread.start()
+        else:
+            self.timed('store_sync', self.load_vector_stores)
+        self.state.save()
+
+        self.startup_stats['seconds'] = round(time.perf_counter() - start, 3)
+        self.startup_stats['api_calls'] = self.api_calls.total() - api_calls if self.api_calls else None
+        self.log_info(f"Assistant {self.assistant_name} started: {self.startup_stats}")
+
+    def timed(self, phase, func):
+        start = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.startup_stats['phases'][phase] = round(time.perf_counter() - start, 3)
+            if phase == 'store_sync' and self.lazy_sync:
+                self.log_info(f"Assistant {self.assistant_name} finished syncing stores in "
+                              f"{self.startup_stats['phases'][phase]}s")
+
+    def load_instructions(self):
+        self.base_instructions = self.build_instructions() + self.dynamic_instructions
+
+    def set_dynamic_instructions(self, dynamic_instructions):
+        self.dynamic_instructions = dynamic_instructions
+        self.load_instructions()
+        self.assistant = self.update_assistant(self.assistant)
+
+    def restore_vector_stores(self):
+        if not self.warm_start:
+            return
+        for store, store_id in self.state['stores'].items():
+            if self.manifest.has_store(store) and (os.path.isdir(f'{self.assistant_folder}/vector_stores/{store}')
+                                                   or os.path.isdir(f'/conf/vaults/{store}')):
+                self.stores.setdefault(store, SimpleNamespace(id=store_id, name=store))
 
     def create_thread(self):
-        self.threads = {
-            'main': self.client.beta.threads.create()
-        }
+        # Reuse the saved threads, they are only verified when a message is sent to them.
+        # New conversations get their thread on their first message.
+        if self.warm_start:
+            for name, thread_id in list(self.state['threads'].items()):
+                self.threads[name] = SimpleNamespace(id=thread_id)
+        else:
+            self.state['threads'] = {}
+
+    def thread_evicted(self, thread, thread_obj):
+        self.log_info(f"Conversation {thread} expired, its next message starts a fresh thread")
+        with self.state.lock:
+            self.state['threads'].pop(thread, None)
 
     def load_assistant(self):
+        assistant_id = self.state['assistant_id'] if self.warm_start else None
+        if assistant_id:
+            try:
+                self.assistant = self.update_assistant(self.client.beta.assistants.retrieve(assistant_id))
+            except NotFoundError:
+                self.log_info(f"Saved assistant {assistant_id} no longer exists, looking it up by name")
+                self.assistant = False
+
+        if not self.assistant:
+            self.find_assistant()
+        self.state['assistant_id'] = self.assistant.id
+
+    def find_assistant(self):
         # Load the assistants
         assistants = self.client.beta.assistants.list()
         for assistant in assistants.data:
             if assistant.name == self.assistant_name:
-                self.log_info(f"Updating assistant with latest instructions and tools: {assistant.name}")
-                self.assistant = self.client.beta.assistants.update(
-                    assistant_id=assistant.id,
-                    instructions=self.base_instructions,
-                    tools=self.tools
-                )
+                self.assistant = self.update_assistant(assistant)
 
         # If assistant is not found create a new assistant
         if not self.assistant:
@@ -89,8 +1259,39 @@ class Assistant:
                 name="home-assistant",
                 instructions=self.base_instructions,
                 tools=self.tools,
-                model="gpt-3.5-turbo",
+                model=self.assistant_model or "gpt-3.5-turbo",
+                metadata={'fingerprint': self.fingerprint()},
             )
+            self.startup_stats['assistant_updated'] = True
+
+    def fingerprint(self):
+        """Stable hash of everything pushed to the assistant, stored in its metadata."""
+        payload = json.dumps(
+            {'instructions': self.base_instructions, 'tools': self.tools, 'model': self.assistant_model},
+            sort_keys=True, separators=(',', ':'), default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def update_assistant(self, assistant):
+        # Skip re-uploading the instructions and tools when the assistant already has them
+        fingerprint = self.fingerprint()
+        metadata = dict(getattr(assistant, 'metadata', None) or {})
+        if metadata.get('fingerprint') == fingerprint:
+            self.log_info(f"Assistant {assistant.name} is up to date, skipping the update")
+            self.startup_stats['assistant_updated'] = False
+            return assistant
+
+        self.log_info(f"Updating assistant with latest instructions and tools: {assistant.name}")
+        metadata['fingerprint'] = fingerprint
+        model = {'model': self.assistant_model} if self.assistant_model else {}
+        self.startup_stats['assistant_updated'] = True
+        return self.client.beta.assistants.update(
+            assistant_id=assistant.id,
+            instructions=self.base_instructions,
+            tools=self.tools,
+            metadata=metadata,
+            **model
+        )
 
     def build_instructions(self):
         # Walk through the assistant folder and load any markdowns as one instruction
@@ -111,21 +1312,15 @@ class Assistant:
         return self.tools
 
     def files_exist_in_vector_store(self, vector_store_id, file_name, get_attribute='id'):
-        all_files = self.client.files.list()
-        all_files = [file.id for file in all_files.data]
-        existing_files = self.client.beta.vector_stores.files.list(vector_store_id=vector_store_id).data
-        for file in existing_files:
-            if file.id in all_files:
-                if get_attribute:
-                    return getattr(file, get_attribute)
+        for file in self.file_index.find(file_name, vector_store_id):
+            if get_attribute:
+                return getattr(file, get_attribute)
         return False
 
     def get_file_info(self, file_id, get_attribute='id'):
-        all_files = self.client.files.list()
-        for file in all_files.data:
-            if file.id == file_id:
-                if get_attribute:
-                    return getattr(file, get_attribute)
+        file = self.file_index.get(file_id)
+        if file and get_attribute:
+            return getattr(file, get_attribute)
         return False
 
     def vector_exists(self, vector_name):
@@ -135,6 +1330,22 @@ class Assistant:
                 return store
         return False
 
+    def get_vector_store(self, store, refresh=False):
+        store_id = self.state['stores'].get(store) if self.warm_start and not refresh else None
+        if store_id:
+            # Trust the saved id, a missing store surfaces as NotFoundError during the sync
+            return SimpleNamespace(id=store_id, name=store)
+
+        vector_store = self.vector_exists(store)
+        if vector_store:
+            self.log_info(f"Vector Store already exists: {store}")
+        else:
+            self.log_info(f"Creating Vector Store: {store}")
+            vector_store = self.client.beta.vector_stores.create(name=store)
+        with self.state.lock:
+            self.state['stores'][store] = vector_store.id
+        return vector_store
+
     def get_files(self, folder, base_folder=None):
         base_folder = base_folder if base_folder else self.assistant_folder
 
@@ -162,83 +1373,255 @@ class Assistant:
 
         return files_folders_found
 
-    def load_vector_stores(self, **kwargs):
-        def loop_through_dict(file_dict, store):
-            for file_name, file_path in file_dict.items():
-                if isinstance(file_path, dict):
-                    loop_through_dict(file_path, store)
-                else:
-                    # Check if the file already exists in the vector store
-                    # If the file has been changed, delete the file and re-upload
-                    file_id = self.files_exist_in_vector_store(self.stores[store].id, file_name)
-                    if file_id:
-                        self.client.files.delete(file_id)
-                    try:
-                        self.streams[store][file_name] = open(file_path, 'rb')
-                    except Exception as e:
-                        self.log_info(f"Failed to open file: {file_path} - {e}")
-
-        self.batches = {}
-        self.stores = {}
-        self.streams = {}
-
-        stores = self.get_files('vector_stores')
-        vaults = self.get_files('vaults', base_folder='/conf')
-
-        # Combine and loop through all stores
-        stores.update(vaults)
-
-        for store in stores:
-            file_paths = stores[store]
-            # Check if the vector store already exists
-            if not self.vector_exists(store):
-                self.log_info(f"Creating Vector Store: {store}")
-                self.stores[store] = self.client.beta.vector_stores.create(name=store)
+    def flatten_files(self, file_dict):
+        file_paths = []
+        for file_name, file_path in file_dict.items():
+            if isinstance(file_path, dict):
+                file_paths.extend(self.flatten_files(file_path))
             else:
-                self.log_info(f"Vector Store already exists: {store}")
-                self.stores[store] = self.vector_exists(store)
-
-            self.streams[store] = {}
-            for file_name, file_path in file_paths.items():
-                file_name = file_name.split("/")[-1]
-                if isinstance(file_path, dict):
-                    loop_through_dict(file_path, store)
-
-                elif isinstance(file_path, str):
-                    # Check if the file already exists in the vector store
-                    # If the file has been changed, delete the file and re-upload
-                    file_id = self.files_exist_in_vector_store(self.stores[store].id, file_name)
-                    if file_id:
-                        self.client.files.delete(file_id)
+                file_paths.append(file_path)
+        return file_paths
+
+    def purge_vector_store(self, vector_store_id):
+        # Remove every file currently attached to the vector store
+        for file_id in list(self.file_index.vector_store_file_ids(vector_store_id)):
+            self.delete_vector_store_file(vector_store_id, file_id)
+
+    def delete_vector_store_file(self, vector_store_id, file_id):
+        try:
+            self.client.beta.vector_stores.files.delete(vector_store_id=vector_store_id, file_id=file_id)
+        except Exception as e:
+            self.log_info(f"Failed to detach file {file_id} from vector store {vector_store_id} - {e}")
+        self.file_index.detach(vector_store_id, file_id)
+        try:
+            self.client.files.delete(file_id)
+        except Exception as e:
+            self.log_info(f"Failed to delete file {file_id} - {e}")
+        self.file_index.remove(file_id)
+
+    def sync_vector_store(self, store, file_paths, scope=None):
+        """Upload, replace or delete only the files of a store that changed since the last sync."""
+        vector_store_id = self.stores[store].id
+        if not self.manifest.has_store(store) and scope is None:
+            # No manifest yet, clear out anything uploaded by previous full re-uploads
+            self.log_info(f"No manifest for Vector Store: {store}, rebuilding it from scratch")
+            self.purge_vector_store(vector_store_id)
+
+        self.update_sync_status(store, status='hashing', files=len(file_paths))
+        added, changed, removed, skipped = self.manifest.diff(store, file_paths, scope)
+
+        # Drop the remote copies of changed and removed files
+        for path in list(changed) + removed:
+            entry = self.manifest.remove(store, path)
+            if entry:
+                self.delete_vector_store_file(vector_store_id, entry['file_id'])
+
+        uploads = {**added, **changed}
+        file_ids = {}
+        if uploads:
+            self.update_sync_status(store, status='uploading', uploaded=0, to_upload=len(uploads))
+            # Files of one store upload side by side too, bounded by upload_concurrency
+            with ThreadPoolExecutor(max_workers=max(1, self.upload_concurrency),
+                                    thread_name_prefix=f'{self.assistant_name}-upload') as executor:
+                futures = {executor.submit(self.upload_file, path): path for path in uploads}
+                for future in as_completed(futures):
+                    path = futures[future]
                     try:
-                        self.streams[store][file_name] = open(file_path, 'rb')
+                        file_ids[path] = future.result().id
+                        self.sync_status[store]['uploaded'] = len(file_ids)
                     except Exception as e:
-                        self.log_info(f"Failed to open file: {file_path} - {e}")
-
-            if self.streams[store]:  # If there are files to upload
-                self.log_info(f"Uploading files to Vector Store: {self.stores[store]}")
+                        self.log_info(f"Failed to upload file: {path} - {e}")
 
-                # Upload file to the vector store
-                self.batches[store] = self.client.beta.vector_stores.file_batches.upload_and_poll(
-                    vector_store_id=self.stores[store].id, files=list(self.streams[store].values())
+        indexed = set()
+        if file_ids:
+            self.update_sync_status(store, status='indexing')
+            self.log_info(f"Uploading {len(file_ids)} files to Vector Store: {store}")
+            try:
+                batch = self.client.beta.vector_stores.file_batches.create_and_poll(
+                    vector_store_id=vector_store_id, file_ids=list(file_ids.values())
                 )
+            except Exception:
+                # Nothing was recorded for these uploads, delete them so the next sync uploads them again
+                for file_id in file_ids.values():
+                    self.delete_vector_store_file(vector_store_id, file_id)
+                raise
+            self.batches[store] = batch
+            self.log_info(f"Batch Status: {batch.status}")
+            self.log_info(f"Files Uploaded: {batch.file_counts}")
+            indexed = self.indexed_batch_files(vector_store_id, batch, file_ids.values())
+            self.file_index.attach(vector_store_id, indexed)
+
+        # Only indexed files go in the manifest, the rest are deleted and retried on the next sync
+        failed = []
+        for path, file_id in file_ids.items():
+            if file_id in indexed:
+                self.manifest.set(store, path, uploads[path], file_id)
+            else:
+                failed.append(path)
+                self.delete_vector_store_file(vector_store_id, file_id)
+        if failed:
+            self.log_info(f"Files not indexed in Vector Store {store}: {failed}")
+
+        report = {
+            'added': len(added),
+            'changed': len(changed),
+            'removed': len(removed),
+            'skipped': len(skipped),
+            'failed': len(failed),
+        }
+        return report
+
+    def upload_file(self, path):
+        with open(path, 'rb') as f:
+            file = self.client.files.create(file=f, purpose='assistants')
+        self.file_index.add(file)
+        return file
+
+    def indexed_batch_files(self, vector_store_id, batch, file_ids):
+        """Ids of the batch's files that finished indexing."""
+        if batch.status == 'completed' and not batch.file_counts.failed and not batch.file_counts.cancelled:
+            return set(file_ids)
+        try:
+            return {
+                file.id for file in self.client.beta.vector_stores.file_batches.list_files(
+                    vector_store_id=vector_store_id, batch_id=batch.id, limit=100
+                ) if file.status == 'completed'
+            }
+        except Exception as e:
+            self.log_info(f"Failed to list the files of batch {batch.id} - {e}")
+            return set()
+
+    def load_vector_stores(self, *folders, **kwargs):
+        folders = folders or ('vector_stores', 'vaults')
 
-                # Check Status
-                self.log_info(f"Batch Status: {self.batches[store].status}")
-                self.log_info(f"Files Uploaded: {self.batches[store].file_counts}")
+        stores = {}
+        if 'vector_stores' in folders:
+            stores.update(self.get_files('vector_stores'))
+        if 'vaults' in folders:
+            stores.update(self.get_files('vaults', base_folder='/conf'))
 
-        # all_files = self.client.files.list()
-        # store_ids = []
-        # for store in self.stores:
-        #     loaded_files = self.client.beta.vector_stores.files.list(vector_store_id=self.stores[store].id).data
-        #     # Build a dictionary of all associated files with the vector store and assistant
-        #     self.files.update({file.id: file for file in all_files.data if file.id in [f.id for f in loaded_files]})
-        #     store_ids.append(self.stores[store].id)  # Store the store ids
+        report = self.sync_stores(
+            {store: (self.flatten_files(stores[store]), None) for store in stores}, refresh_index=True
+        )
 
         # Update the assistant with the last vector store uploaded
+        last_store = list(stores)[-1] if stores else None
+        if last_store in self.stores:
+            self.attach_assistant_vector_stores([self.stores[last_store].id])
+        return report
+
+    def sync_paths(self, paths):
+        """Push only the touched files or folders to the vector stores they belong to."""
+        roots = {
+            'vector_stores': (self.assistant_folder, f'{self.assistant_folder}/vector_stores'),
+            'vaults': ('/conf', '/conf/vaults'),
+        }
+        touched = {}
+        for path in paths:
+            for folder, (base_folder, root) in roots.items():
+                if path.startswith(f"{root}{os.sep}"):
+                    store = os.path.relpath(path, root).split(os.sep)[0]
+                    touched.setdefault((folder, base_folder, store), set()).add(path)
+
+        jobs = {}
+        for (folder, base_folder, store), scope in touched.items():
+            if store.startswith('.') or store.startswith('_'):
+                continue
+            store_folder = f'{base_folder}/{folder}/{store}'
+            if not os.path.isdir(store_folder) and not self.manifest.has_store(store):
+                continue  # A loose file next to the stores, not a store of its own
+            # Walk the store with the usual filters and keep only the files that were touched
+            store_files = self.get_files(f'{folder}/{store}', base_folder=base_folder) \
+                if os.path.isdir(store_folder) else {}
+            file_paths = [path for path in self.flatten_files(store_files) if self.manifest.in_scope(path, scope)]
+            jobs[store] = (file_paths, scope)
+        return self.sync_stores(jobs) if jobs else {}
+
+    def sync_stores(self, jobs, refresh_index=False):
+        report = {}
+        with self.sync_lock:
+            self.batches = {}
+            if refresh_index:
+                # Uploads and deletes keep the index current, only a full sync lists every file again
+                self.file_index.invalidate()
+
+            start = time.perf_counter()
+            for store in jobs:
+                self.sync_status[store] = {'status': 'queued'}
+
+            # Stores upload and poll side by side, bounded by sync_concurrency
+            with ThreadPoolExecutor(max_workers=max(1, self.sync_concurrency),
+                                    thread_name_prefix=f'{self.assistant_name}-sync') as executor:
+                futures = {
+                    executor.submit(self.load_vector_store, store, file_paths, scope): store
+                    for store, (file_paths, scope) in jobs.items()
+                }
+                for future in as_completed(futures):
+                    store = futures[future]
+                    try:
+                        report[store] = future.result()
+                    except Exception as e:
+                        self.update_sync_status(store, status='failed', error=f'{e}')
+                        self.log_info(f"Failed to sync Vector Store {store} - {e}")
+
+            self.sync_generation += 1
+            store_seconds = sum(self.sync_status[store].get('seconds', 0) for store in jobs)
+            self.log_info(
+                f"Synced {len(jobs)} Vector Stores in {time.perf_counter() - start:.1f}s "
+                f"({store_seconds:.1f}s across stores)"
+            )
+        for listener in self.sync_listeners:
+            try:
+                listener()
+            except Exception as e:
+                self.log_info(f"Failed to run sync listener {listener} - {e}")
+        return report
+
+    def load_vector_store(self, store, file_paths, scope=None):
+        start = time.perf_counter()
+        self.set_store(store, self.get_vector_store(store))
+        try:
+            report = self.sync_vector_store(store, file_paths, scope)
+        except NotFoundError:
+            # The saved store is gone, look it up again and rebuild it from scratch
+            self.log_info(f"Saved Vector Store {store} no longer exists, resyncing it")
+            self.manifest.drop_store(store)
+            self.set_store(store, self.get_vector_store(store, refresh=True))
+            report = self.sync_vector_store(store, self.flatten_files(self.store_files(store)))
+        finally:
+            # Persist after every store so an interrupted sync does not re-upload finished stores
+            self.manifest.save()
+
+        self.update_sync_status(store, status='done', seconds=round(time.perf_counter() - start, 2), **report)
+        return report
+
+    def set_store(self, store, vector_store):
+        # Readers copy the stores under the state lock while the background sync adds them
+        with self.state.lock:
+            self.stores[store] = vector_store
+
+    def stores_snapshot(self):
+        """Copy of the stores and their manifest entries, safe to read while a sync is running."""
+        with self.state.lock:
+            return {store: self.manifest.files(store) for store in self.stores}
+
+    def update_sync_status(self, store, **status):
+        self.sync_status.setdefault(store, {}).update(status)
+        self.log_info(f"Vector Store {store}: {self.sync_status[store]}")
+
+    def store_files(self, store):
+        if os.path.isdir(f'{self.assistant_folder}/vector_stores/{store}'):
+            return self.get_files(f'vector_stores/{store}')
+        return self.get_files(f'vaults/{store}', base_folder='/conf')
+
+    def attach_assistant_vector_stores(self, vector_store_ids):
+        tool_resources = getattr(self.assistant, 'tool_resources', None)
+        file_search = getattr(tool_resources, 'file_search', None)
+        if file_search is not None and list(file_search.vector_store_ids or []) == vector_store_ids:
+            return  # Already attached, skip the update
         self.assistant = self.client.beta.assistants.update(
             assistant_id=self.assistant.id,
-            tool_resources={"file_search": {"vector_store_ids": [self.stores[store].id]}}
+            tool_resources={"file_search": {"vector_store_ids": vector_store_ids}}
         )
 
     def send_message(self, system, message):
@@ -248,48 +1631,222 @@ class Assistant:
             messages.append(HumanMessage(content=m))
         return self.message_chain.invoke(response)
 
-    def message(self, thread, content, vector_store=None):
-        self.log_info(f"Received message: {content}")
-
-        def loop_through_function(tool, func):
-            # Make sure \ are properly escaped in the pattern
-            function_args = json.loads(tool.function.arguments.replace("\\", "\\\\"))
-            self.log_info(f"Function Args: {function_args}")
-            # Check if it is a list of commands or just a single command
-            if isinstance(function_args, list):
-                command_responses = []
-                for args in function_args:
-                    # Make sure we revert the pattern back to the original
-                    if 'pattern' in function_args and isinstance(args['pattern'], list):
-                        args['pattern'] = [
-                            p.replace("\\\\", "\\") for p in args['pattern']
-                        ]
-                    elif 'pattern' in function_args:
-                        args['pattern'] = args['pattern'].replace("\\\\", "\\")
-
-                    command_response = func(**args)
-                    self.log_info(f"Command Response: {command_response}")
-                    command_responses.append(command_response)
-                command_response = command_responses
-            else:
+    def loop_through_function(self, tool, func):
+        # Make sure \ are properly escaped in the pattern
+        function_args = json.loads(tool.function.arguments.replace("\\", "\\\\"))
+        self.log_info(f"Function Args: {function_args}")
+        # Check if it is a list of commands or just a single command
+        if isinstance(function_args, list):
+            command_responses = []
+            for args in function_args:
                 # Make sure we revert the pattern back to the original
-                if 'pattern' in function_args and isinstance(function_args['pattern'], list):
-                    function_args['pattern'] = [
-                        p.replace("\\\\", "\\") for p in function_args['pattern']
+                if 'pattern' in function_args and isinstance(args['pattern'], list):
+                    args['pattern'] = [
+                        p.replace("\\\\", "\\") for p in args['pattern']
                     ]
                 elif 'pattern' in function_args:
-                    function_args['pattern'] = function_args['pattern'].replace("\\\\", "\\")
-                self.log_info(func)
-                self.log_info(f"func(**{function_args})")
-                command_response = func(**function_args)
+                    args['pattern'] = args['pattern'].replace("\\\\", "\\")
+
+                args = self.validate_arguments(tool.function.name, func, args)
+                command_response = self.call_tool(tool.function.name, func, args)
                 self.log_info(f"Command Response: {command_response}")
+                command_responses.append(command_response)
+            command_response = command_responses
+        else:
+            # Make sure we revert the pattern back to the original
+            if 'pattern' in function_args and isinstance(function_args['pattern'], list):
+                function_args['pattern'] = [
+                    p.replace("\\\\", "\\") for p in function_args['pattern']
+                ]
+            elif 'pattern' in function_args:
+                function_args['pattern'] = function_args['pattern'].replace("\\\\", "\\")
+            function_args = self.validate_arguments(tool.function.name, func, function_args)
+            self.log_info(func)
+            self.log_info(f"func(**{function_args})")
+            command_response = self.call_tool(tool.function.name, func, function_args)
+            self.log_info(f"Command Response: {command_response}")
+
+        return command_response
+
+    def call_tool(self, name, func, args):
+        ttl = self.tool_cache_ttls.get(name)
+        if not ttl:
+            command_response = func(**args)
+            self.invalidate_tool_cache(name)
+            return command_response
+
+        key = (name, json.dumps(args, sort_keys=True, default=str))
+        missing = object()
+        command_response = self.tool_cache.get(key, missing)
+        if command_response is not missing:
+            self.tool_cache_stats[f'{name}:hits'] += 1
+            self.log_info(f"Reusing cached result of {name}({args})")
+            return command_response
+
+        self.tool_cache_stats[f'{name}:misses'] += 1
+        command_response = func(**args)
+        self.tool_cache.set(key, command_response, ttl=ttl)
+        return command_response
+
+    def invalidate_tool_cache(self, name):
+        # Tools that change the home make the related cached reads stale, reads never invalidate anything
+        if name in READ_ONLY_TOOLS:
+            return
+        related = TOOL_CACHE_INVALIDATIONS.get(name)
+        if related == ():
+            return
+        for listener in self.tool_write_listeners:
+            listener(name, related)
+        dropped = self.tool_cache.invalidate(None if related is None else lambda key, value: key[0] in related)
+        if dropped:
+            self.tool_cache_stats['invalidated'] += dropped
+            self.log_info(f"{name} dropped {dropped} cached tool results")
+
+    def tool_cache_report(self):
+        stats = self.tool_cache.stats()
+        stats['invalidated'] = self.tool_cache_stats['invalidated']
+        stats['tools'] = {}
+        for name in self.tool_cache_ttls:
+            hits, misses = self.tool_cache_stats[f'{name}:hits'], self.tool_cache_stats[f'{name}:misses']
+            if hits or misses:
+                stats['tools'][name] = {'hits': hits, 'misses': misses, 'hit_rate': round(hits / (hits + misses), 3)}
+        return stats
+
+    @staticmethod
+    def validate_arguments(name, func, args):
+        # Bad arguments go back to the model in the tool output instead of failing inside Home Assistant
+        try:
+            allow_unknown = any(
+                parameter.kind == inspect.Parameter.VAR_KEYWORD
+                for parameter in inspect.signature(func).parameters.values()
+            )
+        except (TypeError, ValueError):
+            allow_unknown = True
+        return validate_tool_arguments(name, args, allow_unknown=allow_unknown)
+
+    def run_tool_call(self, tool):
+        start = time.perf_counter()
+        try:
+            command_response = self.loop_through_function(
+                tool=tool,
+                func=self.tool_funcs[tool.function.name]
+            )
+        except ToolArgumentError as e:
+            self.log_info(f"{e}")
+            command_response = f"Error: {e}"
+        except Exception as e:
+            self.log_info(f"Failed to run function: {tool.function.name} - {e}")
+            self.log_info(tool)
+            command_response = f"Error: {e}"
+        self.log_info(f"Tool {tool.function.name} ({tool.id}) took {(time.perf_counter() - start) * 1000:.0f}ms")
+        return {
+            "tool_call_id": tool.id,
+            "output": self.serialize_output(tool.function.name, command_response)
+        }
 
-            tool_outputs.append({
-                "tool_call_id": tool.id,
-                "output": f'{command_response}'
-            })
+    def serialize_output(self, name, command_response):
+        max_chars = self.tool_output_limits.get(name, self.tool_output_limits['default'])
+        output = serialize_tool_output(command_response, max_chars=max_chars)
+        original = len(f'{command_response}')
+        if len(output) < original:
+            self.log_info(f"Compacted {name} output from {original} to {len(output)} characters")
+        return output
+
+    def is_serial_tool(self, name):
+        return name in self.serial_tools or getattr(self.tool_funcs.get(name), 'serial', False)
+
+    def run_tool_calls(self, tool_calls, trace=None):
+        """Run the tool calls of one required action, independent calls side by side on the tool pool."""
+        start = time.perf_counter()
+        parallel = [tool for tool in tool_calls if not self.is_serial_tool(tool.function.name)]
+        serial = [tool for tool in tool_calls if self.is_serial_tool(tool.function.name)]
+
+        outputs = {}
+        if len(parallel) > 1:
+            futures = {tool.id: self.tool_executor.submit(self.run_tool_call, tool) for tool in parallel}
+            outputs.update({tool_id: future.result() for tool_id, future in futures.items()})
+        elif parallel:
+            outputs[parallel[0].id] = self.run_tool_call(parallel[0])
+
+        # Tools that declared themselves serial run one at a time after the parallel batch
+        for tool in serial:
+            outputs[tool.id] = self.run_tool_call(tool)
+
+        self.log_info(f"Ran {len(tool_calls)} tool calls in {(time.perf_counter() - start) * 1000:.0f}ms")
+        if trace is not None:
+            trace['tool_calls'].extend(
+                (tool.function.name, tool.function.arguments, outputs[tool.id]['output']) for tool in tool_calls
+            )
+        # Keep the order of the tool calls in the required action
+        return [outputs[tool.id] for tool in tool_calls]
+
+    def run_tools(self, content):
+        """Tools for a single run, a subset picked from the request when tool_subsets is on, else None for all."""
+        if not self.tool_subsets:
+            return None
+        groups = select_tool_groups(content)
+        tools = [
+            tool for tool in self.tools
+            if tool['type'] == 'file_search' or (tool['type'] == 'code_interpreter' and 'code_interpreter' in groups)
+        ]
+        tools += get_tools(groups + ['request_more_tools'])
+        self.tool_subset_stats['runs'] += 1
+        self.tool_subset_stats['tools_sent'] += len(tools)
+        self.tool_subset_stats['tools_available'] += len(self.tools)
+        self.tool_subset_stats.update(f'group:{group}' for group in groups)
+        self.log_info(f"Sending {len(tools)}/{len(self.tools)} tools for this run: {groups}")
+        return tools
+
+    @staticmethod
+    def more_tools_requested(tool_calls):
+        return any(tool.function.name == 'request_more_tools' for tool in tool_calls)
+
+    def restart_with_all_tools(self, thread, run):
+        # The subset was too small, drop this run and let the next one see every tool
+        self.tool_subset_stats['too_small'] += 1
+        self.log_info(f"Run {run.id} asked for more tools, retrying it with all of them")
+        self.client.beta.threads.runs.cancel(thread_id=thread.id, run_id=run.id)
+        self.client.beta.threads.runs.poll(thread_id=thread.id, run_id=run.id)
+
+    def tool_subset_report(self):
+        stats = self.tool_subset_stats
+        runs = stats['runs']
+        return {
+            'runs': runs,
+            'too_small': stats['too_small'],
+            'too_small_rate': round(stats['too_small'] / runs, 3) if runs else 0,
+            'avg_tools_sent': round(stats['tools_sent'] / runs, 1) if runs else 0,
+            'avg_tools_available': round(stats['tools_available'] / runs, 1) if runs else 0,
+            'groups': {key.split(':', 1)[1]: count for key, count in stats.items() if key.startswith('group:')},
+        }
 
-        thread = self.get_thread(thread, store_id=vector_store)
+    def message(self, thread, content, vector_store=None, user_prompt=None, on_partial=None):
+        """Send content to the thread, user_prompt is the user's own words inside it and picks the run's tools."""
+        # One run at a time per thread, follow up messages are merged into the next run
+        return self.run_coordinator.run(
+            thread,
+            (content, vector_store, user_prompt),
+            lambda batch: self.run_message(thread, *self.merge_messages(batch), on_partial=on_partial),
+        )
+
+    def merge_messages(self, batch):
+        """Fold queued (content, vector_store, user_prompt) messages into one message for a single run."""
+        if len(batch) == 1:
+            return batch[0]
+        self.log_info(f"Merging {len(batch)} queued messages into one run")
+        content = "The user sent several messages while you were busy. Answer all of them in order.\n\n"
+        content += "\n\n".join(f"MESSAGE {i}:\n{message}" for i, (message, *_) in enumerate(batch, start=1))
+        # The most recent message decides which vector store to attach
+        vector_store = next((store for message, store, prompt in reversed(batch) if store), None)
+        user_prompt = "\n".join(prompt or message for message, store, prompt in batch)
+        return content, vector_store, user_prompt
+
+    def run_message(self, thread, content, vector_store=None, user_prompt=None, on_partial=None):
+        self.log_info(f"Received message: {content}")
+
+        thread_name = thread
+        thread = self.get_thread(thread_name, store_id=vector_store)
+        trace = self.run_traces[thread_name] = {'content': content, 'tool_calls': []}
 
         # if vector_store:
         #     # Attach all the files from the vector store to the message
@@ -301,18 +1858,30 @@ class Assistant:
         # else:
         #     attachments = None
 
-        message = self.client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=content,
-            # attachments=attachments,
-            # attachments=[
-            #     {'file_id': file_obj.id, "tools": [{"type": "file_search"}]}
-            #     for file_obj in self.client.files.list().data
-            #     # Make sure file is an accepted file type
-            #     if file_obj.purpose == 'assistants'
-            # ]
-        )
+        try:
+            self.client.beta.threads.messages.create(
+                thread_id=thread.id,
+                role="user",
+                content=content,
+                # attachments=attachments,
+                # attachments=[
+                #     {'file_id': file_obj.id, "tools": [{"type": "file_search"}]}
+                #     for file_obj in self.client.files.list().data
+                #     # Make sure file is an accepted file type
+                #     if file_obj.purpose == 'assistants'
+                # ]
+            )
+        except NotFoundError:
+            # A thread restored from the saved state was deleted remotely, start a fresh one
+            self.log_info(f"Saved thread {thread_name} no longer exists, creating a new one")
+            self.drop_thread(thread_name)
+            thread = self.get_thread(thread_name, store_id=vector_store)
+            self.client.beta.threads.messages.create(thread_id=thread.id, role="user", content=content)
+
+        # The wrapped command carries the date, task descriptions and examples, only the request picks tools
+        tools = self.run_tools(user_prompt or content)
+        if self.stream_responses:
+            return self.stream_run(thread, on_partial, tools=tools, trace=trace)
 
         run = None
         exit_loop_count = 0
@@ -322,39 +1891,26 @@ class Assistant:
                 run = self.client.beta.threads.runs.create_and_poll(
                     thread_id=thread.id,
                     assistant_id=self.assistant.id,
+                    **({'tools': tools} if tools else {})
                 )
 
             if run.status == 'completed':
-                messages = self.client.beta.threads.messages.list(
-                    thread_id=thread.id
-                )
-                self.log_info(f"Run Status 1: {run.status}\n\nMessages: {messages.data[0]}")
-
-                self.check_if_file_was_generated(messages)
-                self.download_open_ai_files()
-                if messages.data[0].content[0].type == 'image_file':
-                    return messages.data[0].content[1].text.value
-                else:
-                    return messages.data[0].content[0].text.value
+                return self.latest_response(thread, run)
 
             elif run.status == 'requires_action':
 
-                # Define the list to store tool outputs
-                tool_outputs = []
-
                 # IF there are tool calls in the required action section
                 self.log_info(f"{run.required_action}")
+                if tools and run.required_action is not None and \
+                        self.more_tools_requested(run.required_action.submit_tool_outputs.tool_calls):
+                    self.restart_with_all_tools(thread, run)
+                    run, tools = None, None
+                    continue
+
                 if run.required_action is not None:
-                    # Loop through each tool in the required action section
-                    for tool in run.required_action.submit_tool_outputs.tool_calls:
-                        try:
-                            loop_through_function(
-                                tool=tool,
-                                func=self.tool_funcs[tool.function.name]
-                            )
-                        except Exception as e:
-                            self.log_info(f"Failed to run function: {tool.function.name} - {e}")
-                            self.log_info(tool)
+                    # Run every tool in the required action section
+                    tool_outputs = self.run_tool_calls(run.required_action.submit_tool_outputs.tool_calls, trace)
+
                     # Submit all tool outputs at once after collecting them in a list
                     if tool_outputs:
                         try:
@@ -370,17 +1926,7 @@ class Assistant:
                         self.log_info("No tool outputs to submit.")
 
                     if run.status == 'completed':
-                        messages = self.client.beta.threads.messages.list(
-                            thread_id=thread.id
-                        )
-                        self.log_info(f"Run Status 2: {run.status}\n\nMessages: {messages.data[0]}")
-                        self.check_if_file_was_generated(messages)
-                        self.download_open_ai_files()
-
-                        if messages.data[0].content[0].type == 'image_file':
-                            return messages.data[0].content[1].text.value
-                        else:
-                            return messages.data[0].content[0].text.value
+                        return self.latest_response(thread, run)
                     else:
                         self.log_info(run.status)
             else:
@@ -392,28 +1938,111 @@ class Assistant:
             if exit_loop_count > 20:
                 break
 
-    def get_thread(self, thread, store_id=None):
-        store_id = self.stores[store_id] if store_id else None
+    def latest_response(self, thread, run):
+        messages = self.client.beta.threads.messages.list(
+            thread_id=thread.id
+        )
+        return self.response_from_messages(messages, run)
 
-        if thread in self.threads:
-            if store_id:
-                # # Update the assistant with the last vector store uploaded
-                # self.assistant = self.client.beta.assistants.update(
-                #     assistant_id=self.assistant.id,
-                #     tool_resources={"file_search": {"vector_store_ids": [store_id.id]}}
-                # )
+    def response_from_messages(self, messages, run):
+        self.log_info(f"Run Status: {run.status}\n\nMessages: {messages.data[0]}")
 
-                # Update the assistant with the vector store ids
+        self.check_if_file_was_generated(messages)
+        self.download_open_ai_files()
+        if messages.data[0].content[0].type == 'image_file':
+            return messages.data[0].content[1].text.value
+        else:
+            return messages.data[0].content[0].text.value
+
+    def stream_run(self, thread, on_partial=None, tools=None, trace=None):
+        """Run through the streaming API, handing sentence sized partial responses to on_partial as text arrives."""
+        pending = ''
+        status = None
+        stream_manager = self.client.beta.threads.runs.stream(
+            thread_id=thread.id,
+            assistant_id=self.assistant.id,
+            **({'tools': tools} if tools else {})
+        )
+        for _ in range(20):
+            action_run = None
+            with stream_manager as stream:
+                for event in stream:
+                    if event.event == 'thread.message.delta':
+                        for block in event.data.delta.content or []:
+                            if block.type == 'text' and block.text and block.text.value:
+                                pending += block.text.value
+                                sentences, pending = split_sentences(pending)
+                                for sentence in sentences:
+                                    if on_partial:
+                                        on_partial(sentence)
+                    elif event.event == 'thread.run.requires_action':
+                        action_run = event.data
+                    elif event.event == 'thread.run.completed':
+                        status = 'completed'
+                    elif event.event in ('thread.run.failed', 'thread.run.cancelled', 'thread.run.expired'):
+                        status = event.data.status
+                        self.log_info(f"Unexpected run status: {event.data.status}")
+                        self.log_info(event.data)
+                run = stream.current_run
+
+            if action_run is None:
+                break
+
+            if tools and self.more_tools_requested(action_run.required_action.submit_tool_outputs.tool_calls):
+                self.restart_with_all_tools(thread, action_run)
+                tools = None
+                stream_manager = self.client.beta.threads.runs.stream(
+                    thread_id=thread.id,
+                    assistant_id=self.assistant.id,
+                )
+                continue
+
+            # Tool calls are handled inline, their outputs continue the same stream
+            self.log_info(f"{action_run.required_action}")
+            tool_outputs = self.run_tool_calls(action_run.required_action.submit_tool_outputs.tool_calls, trace)
+            stream_manager = self.client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=thread.id,
+                run_id=action_run.id,
+                tool_outputs=tool_outputs,
+            )
+
+        if status != 'completed':
+            # No assistant message was added, the latest message is still the user's own command
+            self.log_info(f"Streamed run ended without completing: {status}")
+            return None
+
+        if pending.strip() and on_partial:
+            on_partial(clean_partial(pending))
+        return self.latest_response(thread, run)
+
+    def get_thread(self, thread, store_id=None):
+        store_id = self.stores.get(store_id) if store_id else None
+        self.threads.expire()
+
+        existing = self.threads.get(thread)
+        if existing is not None and store_id:
+            # # Update the assistant with the last vector store uploaded
+            # self.assistant = self.client.beta.assistants.update(
+            #     assistant_id=self.assistant.id,
+            #     tool_resources={"file_search": {"vector_store_ids": [store_id.id]}}
+            # )
+
+            # Update the assistant with the vector store ids
+            try:
                 self.threads[thread] = self.client.beta.threads.update(
-                    thread_id=self.threads[thread].id,
+                    thread_id=existing.id,
                     tool_resources={
                         "file_search": {
                             "vector_store_ids": [store_id.id]
                         }
                     }
                 )
+            except NotFoundError:
+                self.log_info(f"Saved thread {thread} no longer exists, creating a new one")
+                self.drop_thread(thread)
+                existing = None
 
-        else:
+        if existing is None:
             if store_id:
                 # Update the assistant with the last vector store uploaded
                 # self.assistant = self.client.beta.assistants.update(
@@ -421,7 +2050,7 @@ class Assistant:
                 #     tool_resources={"file_search": {"vector_store_ids": [store_id.id]}}
                 # )
                 # Update the assistant with the vector store ids
-                self.threads[thread] = self.client.beta.threads.create(
+                existing = self.client.beta.threads.create(
                     tool_resources={
                         "file_search": {
                             "vector_store_ids": [store_id.id]
@@ -429,9 +2058,19 @@ class Assistant:
                     }
                 )
             else:
-                self.threads[thread] = self.client.beta.threads.create()
+                existing = self.client.beta.threads.create()
 
-        return self.threads[thread]
+            self.threads[thread] = existing
+            with self.state.lock:
+                self.state['threads'][thread] = existing.id
+            self.state.save()
+
+        return self.threads.get(thread, existing)
+
+    def drop_thread(self, thread):
+        self.threads.pop(thread, None)
+        with self.state.lock:
+            self.state['threads'].pop(thread, None)
 
     def check_if_file_was_generated(self, open_ai_response):
         files = {}
@@ -511,15 +2150,13 @@ class Assistant:
 
     def download_open_ai_files(self, file_ids=None):
         files = self.files if file_ids is None else file_ids
-        self.log_info(self.client.files.list())
         downloaded_files = {}
-        for i, file in enumerate(files):
-            file_id = file
-            file = self.files[file_id]
+        for i, file_id in enumerate(files):
+            file_info = self.file_index.get(file_id)
             # Check the purpose of the file
-            if self.get_file_info(file_id, 'purpose') == 'assistants':
+            if file_info is None or file_info.purpose == 'assistants':
                 continue
-            file_name = self.get_file_info(file_id, 'filename')
+            file_name = file_info.filename
             file_name = file_name.split("/")[-1].split(".")[0]
             self.log_info(f"Downloading file: {file_name}")
             image_data = self.client.files.content(file_id)
@@ -722,6 +2359,7 @@ class Assistant:
         )
         return response
 
+    @serial_tool
     def generate_image(self, prompt, n=1):
 
         filepaths = {}
@@ -757,3 +2395,137 @@ class Assistant:
         return list(filepaths.values())
 
 
+class AsyncAssistant(Assistant):
+    """Assistant whose runs go through AsyncOpenAI so many conversations can be in flight on one event loop."""
+
+    def __init__(self, async_client, request_queue, *args, **kwargs):
+        self.async_client = async_client
+        self.request_queue = request_queue
+        super().__init__(*args, **kwargs)
+
+    def message(self, thread, content, vector_store=None, user_prompt=None, on_partial=None):
+        """Blocking entry point, the run still goes through the event loop so every caller shares one coordinator."""
+        return self.request_queue.submit(self.amessage, thread, content, vector_store, user_prompt).result()
+
+    async def amessage(self, thread, content, vector_store=None, user_prompt=None):
+        return await self.run_coordinator.arun(
+            thread,
+            (content, vector_store, user_prompt),
+            lambda batch: self.arun_message(thread, *self.merge_messages(batch)),
+        )
+
+    async def arun_message(self, thread, content, vector_store=None, user_prompt=None):
+        self.log_info(f"Received message: {content}")
+        loop = asyncio.get_running_loop()
+
+        # Thread lookups only touch the network on a miss, keep them on the sync client
+        thread_name = thread
+        thread = await loop.run_in_executor(None, self.get_thread, thread_name, vector_store)
+        trace = self.run_traces[thread_name] = {'content': content, 'tool_calls': []}
+        try:
+            await self.async_client.beta.threads.messages.create(thread_id=thread.id, role="user", content=content)
+        except NotFoundError:
+            self.log_info(f"Saved thread {thread_name} no longer exists, creating a new one")
+            self.drop_thread(thread_name)
+            thread = await loop.run_in_executor(None, self.get_thread, thread_name, vector_store)
+            await self.async_client.beta.threads.messages.create(thread_id=thread.id, role="user", content=content)
+
+        tools = self.run_tools(user_prompt or content)
+        run = await self.async_client.beta.threads.runs.create_and_poll(
+            thread_id=thread.id,
+            assistant_id=self.assistant.id,
+            **({'tools': tools} if tools else {})
+        )
+        for _ in range(20):
+            if run.status == 'completed':
+                messages = await self.async_client.beta.threads.messages.list(thread_id=thread.id)
+                # File downloads and the index page are blocking disk work
+                return await loop.run_in_executor(None, self.response_from_messages, messages, run)
+
+            if run.status != 'requires_action' or run.required_action is None:
+                self.log_info(f"Unexpected run status: {run.status}")
+                self.log_info(run)
+                return None
+
+            if tools and self.more_tools_requested(run.required_action.submit_tool_outputs.tool_calls):
+                self.tool_subset_stats['too_small'] += 1
+                self.log_info(f"Run {run.id} asked for more tools, retrying it with all of them")
+                await self.async_client.beta.threads.runs.cancel(thread_id=thread.id, run_id=run.id)
+                await self.async_client.beta.threads.runs.poll(thread_id=thread.id, run_id=run.id)
+                tools = None
+                run = await self.async_client.beta.threads.runs.create_and_poll(
+                    thread_id=thread.id,
+                    assistant_id=self.assistant.id,
+                )
+                continue
+
+            # Tools are blocking Home Assistant calls, they run on the tool pool
+            self.log_info(f"{run.required_action}")
+            tool_outputs = await loop.run_in_executor(
+                None, self.run_tool_calls, run.required_action.submit_tool_outputs.tool_calls, trace
+            )
+            run = await self.async_client.beta.threads.runs.submit_tool_outputs_and_poll(
+                thread_id=thread.id,
+                run_id=run.id,
+                tool_outputs=tool_outputs,
+            )
+
+
+class AssistantRequestQueue:
+    """Runs assistant coroutines on a background event loop with a cap on how many are in flight."""
+
+    def __init__(self, max_concurrency=4, logger=print):
+        self.log_info = logger
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='assistant-requests', daemon=True)
+        self.thread.start()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.wait_seconds = 0
+
+    def submit(self, coroutine_function, *args, **kwargs):
+        """Queue coroutine_function(*args, **kwargs), returns a concurrent.futures.Future for its result."""
+        with self.lock:
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        return asyncio.run_coroutine_threadsafe(
+            self.run(coroutine_function, args, kwargs, time.monotonic()), self.loop
+        )
+
+    async def run(self, coroutine_function, args, kwargs, submitted):
+        async with self.semaphore:
+            with self.lock:
+                self.queued -= 1
+                self.in_flight += 1
+                self.wait_seconds += time.monotonic() - submitted
+            try:
+                return await coroutine_function(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'max_queue_depth': self.max_queue_depth,
+                'max_concurrency': self.max_concurrency,
+                'avg_wait_ms': round(self.wait_seconds * 1000 / self.completed, 1) if self.completed else 0,
+            }
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,4 +1,6 @@
+import json
 import os
+import re
 
 
 def load_assistant_instructions(assistant, file_name):
@@ -8,3 +10,138 @@ def load_assistant_instructions(assistant, file_name):
         if file_name in file:
             with open(f"/assistants/{assistant}/{file}", 'r') as f:
                 return f.read()
+
+
+def normalize_prompt(prompt):
+    # Lowercase, drop punctuation and collapse whitespace so near identical commands share a key
+    return ' '.join(re.sub(r"[^a-z0-9%' ]+", ' ', f'{prompt}'.lower()).split())
+
+
+def serial_tool(func):
+    # Tools marked serial never run alongside other tool calls of the same required action
+    func.serial = True
+    return func
+
+
+def clean_partial(text):
+    # Drop file citation markers such as 【4:0†source】, they are noise when read aloud
+    return re.sub(r'【[^】]*】', '', text).strip()
+
+
+def split_sentences(text):
+    """Split streamed text into finished sentences and the unfinished remainder."""
+    parts = re.split(r'(?<=[.!?:])\s+', text)
+    sentences = [clean_partial(part) for part in parts[:-1]]
+    return [sentence for sentence in sentences if sentence], parts[-1]
+
+
+def estimate_tokens(text):
+    # About four characters per token for English text, close enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def get_token_counter(counter='estimate', model='gpt-4o'):
+    """Return a function counting the tokens of a text, tiktoken when asked for and installed."""
+    if callable(counter):
+        return counter
+    if counter == 'tiktoken':
+        try:
+            import tiktoken
+            encoding = tiktoken.encoding_for_model(model)
+            return lambda text: len(encoding.encode(text))
+        except (ImportError, KeyError):
+            pass
+    return estimate_tokens
+
+
+def compact_value(value):
+    # Lists of entities read fine comma separated, anything nested stays JSON without the spaces
+    if isinstance(value, (list, tuple, set)):
+        return ','.join(f'{item}' for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, separators=(',', ':'), default=str)
+    return f'{value}'
+
+
+# Fields of Home Assistant states and search results that rarely help the model, dropped first when trimming
+LOW_VALUE_FIELDS = (
+    'context', 'last_reported', 'last_updated', 'entity_picture', 'icon', 'supported_features',
+    'supported_color_modes', 'attribution', 'editable', 'thumbnail', 'favicon',
+)
+
+
+def to_jsonable(value):
+    return json.loads(json.dumps(
+        value, default=lambda item: list(item) if isinstance(item, (set, frozenset)) else f'{item}'
+    ))
+
+
+def dumps_compact(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def drop_fields(data, fields, dropped):
+    if isinstance(data, dict):
+        dropped.update(key for key in data if key in fields)
+        return {key: drop_fields(item, fields, dropped) for key, item in data.items() if key not in fields}
+    if isinstance(data, list):
+        return [drop_fields(item, fields, dropped) for item in data]
+    return data
+
+
+def sample_collections(data, max_items, max_string, sampled, path='$'):
+    """Keep the first max_items of every list or dict and cut long strings, noting each cut in sampled."""
+    if isinstance(data, list):
+        if len(data) > max_items:
+            sampled.append(f"{path} kept {max_items} of {len(data)} items")
+        return [
+            sample_collections(item, max_items, max_string, sampled, f'{path}[{i}]')
+            for i, item in enumerate(data[:max_items])
+        ]
+    if isinstance(data, dict):
+        keys = list(data)
+        if len(keys) > max_items:
+            sampled.append(f"{path} kept {max_items} of {len(keys)} keys")
+        return {
+            key: sample_collections(data[key], max_items, max_string, sampled, f'{path}.{key}')
+            for key in keys[:max_items]
+        }
+    if isinstance(data, str) and len(data) > max_string:
+        sampled.append(f"{path} cut to {max_string} of {len(data)} characters")
+        return data[:max_string] + '…'
+    return data
+
+
+def serialize_tool_output(value, max_chars=4000, max_items=20):
+    """Compact JSON for a tool result, trimmed to max_chars with a note of what was left out."""
+    if isinstance(value, str):
+        if len(value) <= max_chars:
+            return value
+        return (f"{value[:max_chars]}\n[Omitted the last {len(value) - max_chars} of {len(value)} characters, "
+                f"ask a narrower question to see more]")
+
+    data = to_jsonable(value)
+    text = dumps_compact(data)
+    if len(text) <= max_chars:
+        return text
+
+    # Trim in steps, from the least to the most useful data: low value fields, long lists, the tail
+    omitted = []
+    dropped = set()
+    data = drop_fields(data, LOW_VALUE_FIELDS, dropped)
+    if dropped:
+        omitted.append(f"fields {sorted(dropped)}")
+    text = dumps_compact(data)
+
+    sampled, items = [], max_items
+    while len(text) > max_chars and items >= 1:
+        sampled = []
+        text = dumps_compact(sample_collections(data, items, max(200, max_chars // 8), sampled))
+        items //= 2
+    if sampled:
+        omitted.append('; '.join(sampled[:5]) + (f" and {len(sampled) - 5} more cuts" if len(sampled) > 5 else ''))
+
+    if len(text) > max_chars:
+        omitted.append(f"everything after the first {max_chars} characters")
+        text = text[:max_chars]
+    return f"{text}\n[Omitted {'; '.join(omitted)}. Call the tool again with narrower arguments to see more]"
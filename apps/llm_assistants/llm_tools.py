@@ -1,3 +1,7 @@
+import threading
+from llm_helpers import normalize_prompt
+
+
 def define_command_matching_entities():
     tool = [{
         "type": "function",
@@ -465,6 +469,30 @@ def define_get_master_room_functions():
                 }
             }
         },
+        {
+            "type": "function",
+            "function": {
+                "name": "get_automation_status",
+                "description": """
+                    Get the state of the room automation booleans, i.e. which rooms have their automations enabled.
+                    Use summary to get an on/off count per app with only the rooms that differ from the rest.
+                """,
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "app": {
+                            "type": "string",
+                            "description": "App to get the automation status for, leave empty for every app"
+                        },
+                        "summary": {
+                            "type": "boolean",
+                            "description": "Return counts per app and the exceptions instead of every entity"
+                        },
+                    },
+                    "required": []
+                }
+            }
+        },
     ]
 
     return tool
@@ -535,6 +563,7 @@ def define_base_tools():
                     "properties": {
                         "db_agent": {
                             "type": "string",
+                            "enum": ["home-db-agent", "hass-db-agent"],
                             "description": "The database to query (only two choices, 'home-db-agent', 'hass-db-agent')"
                         },
                         "query": {
@@ -707,23 +736,266 @@ def define_base_tools():
     return tools
 
 
+def define_request_more_tools():
+    tool = [{
+        "type": "function",
+        "function": {
+            "name": "request_more_tools",
+            "description": """
+                Only a subset of the functions was made available for this request. Call this function when none of
+                the available functions can complete the request, the request is then retried with every function.
+            """,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "reason": {
+                        "type": "string",
+                        "description": "What you need to do that the available functions cannot"
+                    },
+                },
+                "required": []
+            }
+        }
+    }]
+    return tool
+
+
+TOOL_GROUPS = {
+    "command_matching_entities": define_command_matching_entities,
+    "get_matching_entities": define_get_matching_entities,
+    "shortcut_functions": define_shortcut_functions,
+    "buzzer_desk_functions": define_buzzer_desk_functions,
+    "master_room_functions": define_master_room_functions,
+    "get_master_room_functions": define_get_master_room_functions,
+    "base_tools": define_base_tools,
+    "request_more_tools": define_request_more_tools,
+}
+
+# Groups left out of 'all', they only make sense on a run that got a subset of the tools
+OPTIONAL_TOOL_GROUPS = ("request_more_tools",)
+
+# Groups sent with every request when runs get a subset of the tools, the rest are picked by keyword
+ALWAYS_TOOL_GROUPS = ("command_matching_entities", "get_matching_entities")
+TOOL_GROUP_KEYWORDS = {
+    "shortcut_functions": (
+        "room", "home", "house", "where", "who", "location", "setting", "settings", "music", "song", "songs",
+        "play", "album", "artist", "playlist", "listen",
+    ),
+    "buzzer_desk_functions": ("buzzer", "beep", "desk", "notify", "height", "sit", "stand", "standing"),
+    "master_room_functions": ("override", "overrides", "master"),
+    "get_master_room_functions": ("override", "overrides", "master"),
+    "base_tools": (
+        "search", "internet", "google", "web", "youtube", "video", "database", "db", "inventory", "sql", "remember",
+        "prefer", "preference", "preferences", "always", "never", "image", "picture", "draw", "generate",
+        # run_master_on/off_automation, plain device commands are handled by command_matching_entities
+        "automation", "automations", "master", "everything",
+    ),
+    "code_interpreter": (
+        "calculate", "compute", "chart", "plot", "graph", "csv", "spreadsheet", "file", "files", "download", "python",
+    ),
+}
+
+# Seconds a read only tool result is reused for the same arguments, tools missing here are never cached
+READ_ONLY_TOOL_TTLS = {
+    "get_room_info": 15,
+    "get_home_info": 15,
+    "get_home_settings": 30,
+    "get_matching_entities": 10,
+    "get_master_overrides": 30,
+    "get_user_overrides": 30,
+    "get_automation_status": 15,
+}
+
+# Tools that only read, a response built from nothing else can be reused until what it read changes
+READ_ONLY_TOOLS = frozenset(READ_ONLY_TOOL_TTLS) | {
+    "get_user_info", "search_music", "search_internet", "get_youtube_video", "db_agent",
+}
+
+# Cached results a tool call makes stale, tools missing here drop the whole cache
+STATE_READ_TOOLS = ("get_room_info", "get_home_info", "get_home_settings", "get_matching_entities",
+                    "get_automation_status")
+OVERRIDE_READ_TOOLS = ("get_master_overrides", "get_user_overrides", "get_automation_status")
+TOOL_CACHE_INVALIDATIONS = {
+    "command_matching_entities": STATE_READ_TOOLS,
+    "run_master_on_automation": STATE_READ_TOOLS,
+    "run_master_off_automation": STATE_READ_TOOLS,
+    "notify_desk": STATE_READ_TOOLS,
+    "adjust_desk_height": STATE_READ_TOOLS,
+    "play_music": STATE_READ_TOOLS,
+    "control_master_overrides": OVERRIDE_READ_TOOLS,
+    "control_user_overrides": OVERRIDE_READ_TOOLS,
+    "play_buzzer": (),
+    "get_user_info": (),
+    "search_music": (),
+    "search_internet": (),
+    "get_youtube_video": (),
+    "db_agent": (),
+    "modify_home_database": (),
+    "log_user_preferences": (),
+    "generate_image": (),
+    "request_more_tools": (),
+}
+
+# Schemas are built, frozen and compiled once per group, every get_tools call shares them
+_registry_lock = threading.Lock()
+_schemas = {}
+_validators = {}
+
+
+class ToolArgumentError(ValueError):
+    """The model called a tool with arguments that do not match its schema."""
+
+
+class FrozenSchema(dict):
+    """A dict that refuses changes, so no caller can edit the shared schemas by accident."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Tool schemas are shared and read only, copy them before changing them")
+
+    __setitem__ = __delitem__ = update = pop = popitem = setdefault = clear = _readonly
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenSchema({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+# String arguments the tools also accept as a list of strings, every other string argument must be a string
+LIST_STRING_ARGUMENTS = frozenset({'pattern'})
+
+
+def compile_validator(schema, path='arguments'):
+    """Turn a JSON schema into a function that coerces a value and collects what is wrong with it."""
+    kind = schema.get('type')
+    enum = schema.get('enum')
+
+    if kind == 'object':
+        properties = {
+            key: compile_validator(item, key if path == 'arguments' else f'{path}.{key}')
+            for key, item in schema.get('properties', {}).items()
+        }
+        required = tuple(schema.get('required', ()))
+
+        def validate(value, errors, allow_unknown=False):
+            if not isinstance(value, dict):
+                errors.append(f"{path} must be an object, got {value!r}")
+                return value
+            for key in required:
+                if value.get(key) is None:
+                    errors.append(f"missing required argument '{key}'")
+            result = {}
+            for key, item in value.items():
+                if key in properties:
+                    result[key] = item if item is None else properties[key](item, errors)
+                elif allow_unknown or not properties:
+                    result[key] = item  # Free form objects such as kwargs take anything
+                else:
+                    errors.append(f"unknown argument '{key}', expected one of {sorted(properties)}")
+            return result
+        return validate
+
+    if kind == 'array':
+        item_validator = compile_validator(schema.get('items', {}), f'{path}[]')
+
+        def validate(value, errors, allow_unknown=False):
+            if not isinstance(value, (list, tuple)):
+                value = [value]  # A single value where a list was expected
+            return [item_validator(item, errors) for item in value]
+        return validate
+
+    def validate(value, errors, allow_unknown=False):
+        value = coerce_scalar(kind, value, path, errors)
+        if enum and value not in enum:
+            matches = [option for option in enum if f'{option}'.lower() == f'{value}'.lower()]
+            if matches:
+                return matches[0]
+            errors.append(f"'{path}' must be one of {list(enum)}, got {value!r}")
+        return value
+    return validate
+
+
+def coerce_scalar(kind, value, path, errors):
+    if kind == 'string':
+        if isinstance(value, str):
+            return value
+        if path.rsplit('.', 1)[-1] in LIST_STRING_ARGUMENTS and isinstance(value, list) \
+                and all(isinstance(item, str) for item in value):
+            return value  # Pattern arguments also take a list of patterns
+        if isinstance(value, (int, float)):
+            return f'{value}'
+    elif kind in ('number', 'integer'):
+        if isinstance(value, str):
+            try:
+                value = float(value.strip())
+            except ValueError:
+                pass
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if kind == 'number':
+                return int(value) if isinstance(value, float) and value.is_integer() else value
+            if float(value).is_integer():
+                return int(value)
+    elif kind == 'boolean':
+        if isinstance(value, bool):
+            return value
+        if f'{value}'.strip().lower() in ('true', '1', 'yes', 'on'):
+            return True
+        if f'{value}'.strip().lower() in ('false', '0', 'no', 'off'):
+            return False
+    else:
+        return value  # No type to check against
+    errors.append(f"'{path}' must be {'an' if kind == 'integer' else 'a'} {kind}, got {value!r}")
+    return value
+
+
+def load_tool_group(tool_name):
+    with _registry_lock:
+        if tool_name not in _schemas:
+            schemas = freeze(TOOL_GROUPS[tool_name]())
+            for schema in schemas:
+                function = schema['function']
+                _validators[function['name']] = compile_validator(function.get('parameters', {}))
+            _schemas[tool_name] = schemas
+        return _schemas[tool_name]
+
+
+def validate_tool_arguments(name, args, allow_unknown=False):
+    """Return the arguments coerced to the tool schema, or raise ToolArgumentError listing every problem."""
+    for tool_name in TOOL_GROUPS:
+        load_tool_group(tool_name)
+    validator = _validators.get(name)
+    if validator is None:
+        return args  # Tools without a schema are passed through as they are
+
+    errors = []
+    args = validator(args, errors, allow_unknown=allow_unknown)
+    if errors:
+        raise ToolArgumentError(
+            f"Invalid arguments for {name}: {'; '.join(errors)}. Call {name} again with corrected arguments."
+        )
+    return args
+
+
 def get_tools(tool_names):
     tools = []
 
-    tool_dict = {
-        "command_matching_entities": define_command_matching_entities,
-        "get_matching_entities": define_get_matching_entities,
-        "shortcut_functions": define_shortcut_functions,
-        "buzzer_desk_functions": define_buzzer_desk_functions,
-        "master_room_functions": define_master_room_functions,
-        "get_master_room_functions": define_get_master_room_functions,
-        "base_tools": define_base_tools
-    }
     if tool_names == 'all':
-        tool_names = list(tool_dict.keys())
+        tool_names = [tool_name for tool_name in TOOL_GROUPS if tool_name not in OPTIONAL_TOOL_GROUPS]
 
     for tool_name in tool_names:
-        tool_function = tool_dict.get(tool_name)
-        if tool_function is not None:
-            tools.extend(tool_function())
+        if tool_name in TOOL_GROUPS:
+            tools.extend(load_tool_group(tool_name))
     return tools
+
+
+def select_tool_groups(text):
+    """Pick the tool groups a request needs from the words in it."""
+    normalized = normalize_prompt(text)
+    words = set(normalized.split())
+    groups = list(ALWAYS_TOOL_GROUPS)
+    for tool_name, keywords in TOOL_GROUP_KEYWORDS.items():
+        if any(keyword in words if ' ' not in keyword else keyword in normalized for keyword in keywords):
+            groups.append(tool_name)
+    return groups